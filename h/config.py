@@ -70,6 +70,10 @@ SETTINGS = [
     EnvSetting('h.db.should_drop_all', 'MODEL_DROP_ALL', type=asbool),
     EnvSetting('h.proxy_auth', 'PROXY_AUTH', type=asbool),
     EnvSetting('h.search.autoconfig', 'SEARCH_AUTOCONFIG', type=asbool),
+    EnvSetting('h.streamer.handler_pool_size', 'STREAMER_HANDLER_POOL_SIZE',
+               type=int),
+    EnvSetting('h.streamer.work_queue_size', 'STREAMER_WORK_QUEUE_SIZE',
+               type=int),
     EnvSetting('h.websocket_url', 'WEBSOCKET_URL'),
     # The client Sentry DSN should be of the public kind, lacking the password
     # component in the DSN URI.
@@ -14,6 +14,7 @@ import pyramid_jinja2
 from pyramid.path import AssetResolver
 
 from h import i18n
+from h._compat import PY2
 
 
 ENVIRONMENT_KEY = 'h.form.jinja2_environment'
@@ -124,7 +125,7 @@ def handle_form_submission(request, form, on_success, on_failure):
 
     """
     try:
-        appstruct = form.validate(request.POST.items())
+        appstruct = form.validate(_controls(request.POST))
     except deform.ValidationFailure:
         result = on_failure()
         request.response.status_int = 400
@@ -141,6 +142,18 @@ def handle_form_submission(request, form, on_success, on_failure):
     return to_xhr_response(request, result, form)
 
 
+def _controls(params):
+    """
+    Return an iterator over the ``(name, value)`` pairs in ``params``.
+
+    deform only iterates over the submitted controls once, so there's no need
+    to copy them into a list first.
+    """
+    if PY2:
+        return params.iteritems()
+    return iter(params.items())
+
+
 def to_xhr_response(request, non_xhr_result, form):
     """
     Return an XHR response for the given ``form``, or ``non_xhr_result``.
@@ -2,6 +2,8 @@
 
 from functools import partial
 
+import sqlalchemy as sa
+
 from h import session
 from h.models import Group
 
@@ -46,10 +48,13 @@ class GroupsService(object):
         """Add `userid` to the member list of `group`."""
         user = self.user_fetcher(userid)
 
-        if user in group.members:
+        if self._is_member(group, user):
             return
 
-        group.members.append(user)
+        # Add the group through the user rather than the group, so that we
+        # don't load every member of the group. The backref records the
+        # change on the group without loading its members either.
+        user.groups.append(group)
 
         if self.publish:
             self.publish('group-join', group.pubid, userid)
@@ -58,14 +63,33 @@ class GroupsService(object):
         """Remove `userid` from the member list of `group`."""
         user = self.user_fetcher(userid)
 
-        if user not in group.members:
+        if not self._is_member(group, user):
             return
 
-        group.members.remove(user)
+        # See the comment in member_join.
+        user.groups.remove(group)
 
         if self.publish:
             self.publish('group-leave', group.pubid, userid)
 
+    def _is_member(self, group, user):
+        """
+        Return True if `user` is a member of `group`.
+
+        The authentication policy has usually already loaded the user's groups
+        in order to compute their principals, in which case we can answer from
+        those without going back to the database. Otherwise, if the group's
+        member list hasn't been loaded either, we ask the database directly
+        rather than loading every member just to test membership.
+        """
+        if 'groups' not in sa.inspect(user).unloaded:
+            return group in user.groups
+
+        state = sa.inspect(group)
+        if state.persistent and 'members' in state.unloaded:
+            return Group.is_member(self.session, group.id, user.id)
+        return user in group.members
+
 
 def groups_factory(context, request):
     """Return a GroupsService instance for the passed context and request."""
@@ -21,8 +21,13 @@ class GroupFactory(object):
         self.request = request
 
     def __getitem__(self, pubid):
+        # The group's ACL refers to its creator, so load the creator along
+        # with the group rather than lazily in a second query.
+        query = (self.request.db.query(Group)
+                 .options(sa.orm.joinedload(Group.creator))
+                 .filter_by(pubid=pubid))
         try:
-            return self.request.db.query(Group).filter_by(pubid=pubid).one()
+            return query.one()
         except exc.NoResultFound:
             raise KeyError()
 
@@ -109,6 +114,19 @@ class Group(Base, mixins.Timestamps):
         """Return a query object filtering groups by creator."""
         return session.query(cls).filter(Group.creator == user)
 
+    @classmethod
+    def is_member(cls, session, group_id, user_id):
+        """
+        Return True if the user with `user_id` is a member of the group.
+
+        This issues a single ``EXISTS`` query against the membership table
+        rather than loading the whole member list of the group.
+        """
+        query = sa.exists().where(
+            USER_GROUP_TABLE.c.group_id == group_id).where(
+            USER_GROUP_TABLE.c.user_id == user_id)
+        return session.query(query).scalar()
+
 
 USER_GROUP_TABLE = sa.Table(
     'user_group', Base.metadata,
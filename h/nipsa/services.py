@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import sqlalchemy as sa
+
 from h.models import User
 from h.nipsa import worker
 
@@ -29,6 +31,23 @@ class NipsaService(object):
                                                  nipsa=True).count()
         return cnt != 0
 
+    def flagged_userids(self, userids):
+        """
+        Return those of the given userids which are flagged as "NIPSA".
+
+        This checks all of the userids with a single query.
+
+        :rtype: set of unicode strings
+        """
+        userids = set(u for u in userids if u is not None)
+        if not userids:
+            return set()
+
+        users = (self.session.query(User)
+                 .filter(sa.or_(*[User.userid == u for u in userids]))
+                 .filter_by(nipsa=True))
+        return set(user.userid for user in users)
+
     def flag(self, user):
         """
         Add a NIPSA flag for a user.
@@ -43,6 +43,7 @@ SCHEMA = {
 class FilterHandler(object):
     def __init__(self, filter_json):
         self.filter = filter_json
+        self.actions = frozenset(filter_json['actions'])
 
     # operators
     operators = {
@@ -149,8 +150,11 @@ class FilterHandler(object):
                 return False
         return True
 
+    def match_action(self, action=None):
+        return not action or action == 'past' or action in self.actions
+
     def match(self, target, action=None):
-        if not action or action == 'past' or action in self.filter['actions']:
+        if self.match_action(action):
             if len(self.filter['clauses']) > 0:
                 return getattr(self, self.filter['match_policy'])(target)
             else:
@@ -1,14 +1,19 @@
 # -*- coding: utf-8 -*-
 
+from collections import OrderedDict
 from collections import namedtuple
+import json
 import logging
 
+from gevent.pool import Pool
 from gevent.queue import Full
+from pyramid import security
 
 from h import realtime
 from h.realtime import Consumer
 from memex import presenters
 from memex import storage
+from memex.db.types import InvalidUUID
 from memex.links import LinksService
 from h.auth.util import translate_annotation_principals
 from h.nipsa.services import NipsaService
@@ -22,6 +27,17 @@ log = logging.getLogger(__name__)
 # An incoming message from a subscribed realtime consumer
 Message = namedtuple('Message', ['topic', 'payload'])
 
+# The registry key under which the streamer keeps its links service
+LINKS_SERVICE_KEY = 'h.streamer.links_service'
+
+# The default number of greenlets each realtime consumer uses to put the
+# messages it receives onto the work queue
+HANDLER_POOL_SIZE = 16
+
+# How long to wait for messages already received to be put on the work
+# queue once a realtime consumer has stopped
+HANDLER_POOL_JOIN_TIMEOUT = 1
+
 
 def process_messages(settings, routing_key, work_queue, raise_error=True):
     """
@@ -31,16 +47,29 @@ def process_messages(settings, routing_key, work_queue, raise_error=True):
     This sets up a :py:class:`h.realtime.Consumer` to route messages from
     `routing_key` to the passed `work_queue`, and starts it. The consumer
     should never return. If it does, this function will raise an exception.
+
+    Received messages are put on the work queue from a small pool of
+    greenlets, so that the consumer can carry on receiving messages while
+    waiting for space on a full work queue. This only absorbs bursts: once
+    every greenlet in the pool is waiting, spawning another blocks, and the
+    consumer stalls on a full work queue just as it did without the pool.
     """
 
-    def _handler(payload):
+    def _do_put(payload):
         try:
             message = Message(topic=routing_key, payload=payload)
-            work_queue.put(message, timeout=0.1)
+            with statsd_client.timer('streamer.handler.queue_put'):
+                work_queue.put(message, timeout=0.1)
         except Full:
             log.warn('Streamer work queue full! Unable to queue message from '
                      'h.realtime having waited 0.1s: giving up.')
+            statsd_client.incr('streamer.work_queue.full')
 
+    def _handler(payload):
+        pool.spawn(_do_put, payload)
+
+    pool = Pool(size=int(settings.get('h.streamer.handler_pool_size',
+                                      HANDLER_POOL_SIZE)))
     conn = realtime.get_connection(settings)
     sentry_client = h.sentry.get_client(settings)
     statsd_client = h.stats.get_client(settings)
@@ -50,140 +79,285 @@ def process_messages(settings, routing_key, work_queue, raise_error=True):
                         sentry_client=sentry_client,
                         statsd_client=statsd_client)
     consumer.run()
+    pool.join(timeout=HANDLER_POOL_JOIN_TIMEOUT)
 
     if raise_error:
         raise RuntimeError('Realtime consumer quit unexpectedly!')
 
 
-def handle_message(message, session, topic_handlers):
+def handle_messages(batch, session, topic_handlers, stats):
     """
-    Deserialize and process a message from the reader.
+    Deserialize and process a batch of messages from the reader.
+
+    The messages in `batch` are grouped by topic, and the handler for each
+    topic is called once with the list of message payloads for that topic,
+    the list of :py:class:`h.streamer.WebSocket` instances, the database
+    session, and the statsd client or pipeline `stats`. Messages with the
+    same topic are handled in the order in which they were received.
+
+    Handlers should send a message to each socket that should be notified
+    about each of the payloads. It is assumed that there is a 1:1
+    request-reply mapping between incoming messages and messages to be sent
+    out over each websocket.
 
-    For each message, `handler` is called with the deserialized message and a
-    single :py:class:`h.streamer.WebSocket` instance, and should return the
-    message to be sent to the client on that socket. The handler can return
-    `None`, to signify that no message should be sent, or a JSON-serializable
-    object. It is assumed that there is a 1:1 request-reply mapping between
-    incoming messages and messages to be sent out over the websockets.
+    `topic_handlers` must have a handler for every topic the streamer
+    subscribes to: a message from any other topic raises KeyError.
+
+    Any exception raised by a topic's handler is logged, so that a failure
+    handling one topic's messages doesn't lose the other messages in the
+    batch.
     """
-    try:
-        handler = topic_handlers[message.topic]
-    except KeyError:
-        raise RuntimeError("Don't know how to handle message from topic: "
-                           "{}".format(message.topic))
+    payloads_by_topic = OrderedDict()
+    for message in batch:
+        payloads_by_topic.setdefault(message.topic, []).append(message.payload)
+
+    # N.B. We iterate over a snapshot of the instances rather than the weak
+    # set itself because there's nothing to stop connections being added or
+    # dropped during iteration, and if that happens Python will throw a "Set
+    # changed size during iteration" error.
+    sockets = websocket.WebSocket.snapshot()
+    for topic, payloads in payloads_by_topic.items():
+        handler = topic_handlers[topic]
+        try:
+            handler(payloads, sockets, session, stats)
+        except Exception:
+            log.exception('Caught exception handling %s messages:', topic)
+
 
-    # N.B. We iterate over a non-weak list of instances because there's nothing
-    # to stop connections being added or dropped during iteration, and if that
-    # happens Python will throw a "Set changed size during iteration" error.
-    sockets = list(websocket.WebSocket.instances)
-    handler(message.payload, sockets, session)
+def handle_annotation_events(payloads, sockets, session, stats):
+    """
+    Send each annotation event in `payloads` to the websockets in `sockets`.
 
+    `payloads` is the list of annotation messages in the batch, in the order
+    they were received, and `sockets` is the snapshot of open websockets
+    shared by the whole batch. The annotations and their authors' NIPSA flags
+    are loaded with `session` once for the batch, and `stats` is used to time
+    each event's serialization and fanout.
+    """
+    # Clients are never notified about read events, so there is no need to
+    # go any further with them.
+    payloads = [m for m in payloads if m['action'] != 'read']
+    if not payloads:
+        return
+
+    # Load all the annotations, and the NIPSA flags of their authors, for the
+    # whole batch at once rather than querying the database for each event.
+    annotations = _fetch_annotations(session,
+                                     [m['annotation_id'] for m in payloads])
+    userids = [_annotation_userid(m, annotations.get(m['annotation_id']))
+               for m in payloads]
+    nipsa_service = NipsaService(session)
+    nipsad_userids = nipsa_service.flagged_userids(userids)
+
+    # Only sockets with a filter that accepts an event's action can be sent
+    # anything about it, so work out which those are once for the batch.
+    sockets_by_action = {}
+    for action in set(m['action'] for m in payloads):
+        sockets_by_action[action] = _sockets_for_action(sockets, action)
+
+    # The sockets in the batch, for checking NIPSA'd users' own sockets
+    # against. Only built if there is a NIPSA'd user in the batch.
+    socket_set = None
+
+    for message, userid in zip(payloads, userids):
+        annotation = annotations.get(message['annotation_id'])
+        user_nipsad = userid in nipsad_userids
+        if user_nipsad:
+            # Annotations by NIPSA'd users are only ever sent to the users
+            # themselves, so there is no need to look at anyone else's
+            # websockets.
+            if socket_set is None:
+                socket_set = frozenset(sockets)
+            user_instances = [
+                s for s in websocket.WebSocket.user_instances(userid)
+                if s in socket_set]
+            action_sockets = _sockets_for_action(user_instances,
+                                                 message['action'])
+        else:
+            action_sockets = sockets_by_action[message['action']]
+        try:
+            _send_annotation_event(message,
+                                   action_sockets,
+                                   annotation,
+                                   user_nipsad,
+                                   stats)
+        except Exception:
+            # Don't let one bad event stop the rest of the batch being sent.
+            log.exception('Caught exception handling annotation event:')
 
-def handle_annotation_event(message, sockets, session):
-    id_ = message['annotation_id']
-    annotation = storage.fetch_annotation(session, id_)
 
+def handle_user_events(payloads, sockets, session, stats):
+    """
+    Send each user event in `payloads` to the event user's websockets.
+
+    User events are only ever sent to the websockets of the user they are
+    about, which are looked up in
+    :py:attr:`h.streamer.websocket.WebSocket.instances_by_userid` rather than
+    found by checking each of `sockets`.
+    """
+    for message in payloads:
+        try:
+            handle_user_event(message)
+        except Exception:
+            # Don't let one bad event stop the rest of the batch being sent.
+            log.exception('Caught exception handling user event:')
+
+
+def _sockets_for_action(sockets, action):
+    """Return those of `sockets` with a filter that accepts `action`."""
+    return [s for s in sockets
+            if s.filter is not None and s.filter.match_action(action)]
+
+
+def _fetch_annotations(session, ids):
+    """Return a dict of the annotations with the given ids, keyed by id."""
+    try:
+        annotations = storage.fetch_ordered_annotations(session, ids)
+    except InvalidUUID:
+        # Don't let one malformed id spoil the whole batch.
+        annotations = [storage.fetch_annotation(session, id_) for id_ in ids]
+    return {a.id: a for a in annotations if a is not None}
+
+
+def _annotation_userid(message, annotation):
+    """Return the userid of the author of the annotation in `message`."""
     # FIXME: It isn't really nice to try and get the userid from the fetched
     # annotation or otherwise get it from the maybe-already serialized
     # annotation dict, to then only access the database for the nipsa flag once.
     # We do this because the event action is `delete` at which point we can't
     # load the annotation from the database. Handling annotation deletions is
     # a known problem and will be fixed in the future.
-    userid = None
     if annotation:
-        userid = annotation.userid
-    else:
-        userid = message.get('annotation_dict', {}).get('user')
-    nipsa_service = NipsaService(session)
-    user_nipsad = nipsa_service.is_flagged(userid)
-
-    for socket in sockets:
-        reply = _generate_annotation_event(message, socket, annotation, user_nipsad)
-        if reply is None:
-            continue
-        socket.send_json(reply)
+        return annotation.userid
+    return message.get('annotation_dict', {}).get('user')
 
 
-def handle_user_event(message, sockets, _):
-    for socket in sockets:
-        reply = _generate_user_event(message, socket)
-        if reply is None:
-            continue
-        socket.send_json(reply)
+def _send_annotation_event(message, sockets, annotation, user_nipsad, stats):
+    if not sockets:
+        return
 
+    if message['action'] == 'delete':
+        serialized = message['annotation_dict']
+    elif annotation is None:
+        return
+    else:
+        # The serialized annotation is the same for every socket, and all
+        # sockets share the application registry, so serialize it just once.
+        with stats.timer('streamer.annotation.serialize'):
+            serialized = _present_annotation(annotation, sockets[0].registry)
+
+    read_principals = _read_principals(serialized.get('permissions', {}))
+    if security.Everyone in read_principals:
+        # Every socket has the Everyone principal, so there is no need to
+        # check each socket's principals for an annotation anyone can read.
+        read_principals = None
+
+    # The notification is the same for every socket that is sent it, so it
+    # is built and encoded once, when the first such socket is found.
+    data = None
+    with stats.timer('streamer.annotation.fanout'):
+        for socket in sockets:
+            if not _should_receive_annotation_event(message,
+                                                    socket,
+                                                    serialized,
+                                                    user_nipsad,
+                                                    read_principals):
+                continue
+            if data is None:
+                notification = _generate_annotation_event(message, serialized)
+                data = json.dumps(notification)
+            socket.send_raw(data)
+
+
+def handle_user_event(message):
+    # Only the event's user is sent anything about it, so look up their
+    # websockets rather than checking every open one.
+    target_sockets = websocket.WebSocket.user_instances(message['userid'])
+    if not target_sockets:
+        return
+
+    data = json.dumps(_generate_user_event(message))
+    for socket in target_sockets:
+        socket.send_raw(data)
+
+
+def _present_annotation(annotation, registry):
+    """Return the JSON-serializable representation of `annotation`."""
+    links_service = _links_service(registry)
+    return presenters.AnnotationJSONPresenter(annotation,
+                                              links_service).asdict()
+
+
+def _links_service(registry):
+    """
+    Return a links service for the passed registry.
 
-def _generate_annotation_event(message, socket, annotation, user_nipsad):
+    The links service only depends on the registry and its settings, so it is
+    created once and kept in the registry rather than built for every message.
     """
-    Get message about annotation event `message` to be sent to `socket`.
+    links_service = registry.get(LINKS_SERVICE_KEY)
+    if links_service is None:
+        base_url = registry.settings.get('h.app_url', 'http://localhost:5000')
+        links_service = LinksService(base_url, registry)
+        registry[LINKS_SERVICE_KEY] = links_service
+    return links_service
 
-    Inspects the embedded annotation event and decides whether or not the
-    passed socket should receive notification of the event.
 
-    Returns None if the socket should not receive any message about this
-    annotation event, otherwise a dict containing information about the event.
+def _should_receive_annotation_event(message, socket, serialized, user_nipsad,
+                                     read_principals):
     """
-    action = message['action']
+    Return True if `socket` should be notified of annotation event `message`.
 
-    if action == 'read':
-        return None
+    Inspects the embedded annotation event and decides whether or not the
+    passed socket should receive notification of the event. The checks are
+    made cheapest first, as most sockets are usually rejected.
 
+    `read_principals` is None if anyone can read the annotation.
+    """
     if message['src_client_id'] == socket.client_id:
-        return None
+        return False
 
     # We don't send anything until we have received a filter from the client
     if socket.filter is None:
-        return None
+        return False
 
-    notification = {
-        'type': 'annotation-notification',
-        'options': {'action': action},
-    }
-    id_ = message['annotation_id']
+    userid = serialized.get('user')
+    if user_nipsad and socket.authenticated_userid != userid:
+        return False
 
-    # Return early when action is delete
-    serialized = None
-    if action == 'delete':
-        serialized = message['annotation_dict']
-    else:
-        if annotation is None:
-            return None
+    if read_principals is not None and not _authorized_to_read(
+            socket.effective_principals_set, read_principals):
+        return False
 
-        base_url = socket.registry.settings.get('h.app_url',
-                                                'http://localhost:5000')
-        links_service = LinksService(base_url, socket.registry)
-        serialized = presenters.AnnotationJSONPresenter(annotation,
-                                                        links_service).asdict()
+    return socket.filter.match(serialized, message['action'])
 
-    userid = serialized.get('user')
-    if user_nipsad and socket.authenticated_userid != userid:
-        return None
 
-    permissions = serialized.get('permissions')
-    if not _authorized_to_read(socket.effective_principals, permissions):
-        return None
+def _generate_annotation_event(message, serialized):
+    """
+    Get message about annotation event `message`.
 
-    if not socket.filter.match(serialized, action):
-        return None
+    Returns a dict containing information about the event, which is the same
+    for every socket that should receive it.
+    """
+    action = message['action']
+
+    notification = {
+        'type': 'annotation-notification',
+        'options': {'action': action},
+    }
 
     notification['payload'] = [serialized]
     if action == 'delete':
-        notification['payload'] = [{'id': id_}]
+        notification['payload'] = [{'id': message['annotation_id']}]
     return notification
 
 
-def _generate_user_event(message, socket):
+def _generate_user_event(message):
     """
-    Get message about user event `message` to be sent to `socket`.
-
-    Inspects the embedded user event and decides whether or not the passed
-    socket should receive notification of the event.
+    Get message about user event `message` to be sent to the event's user.
 
-    Returns None if the socket should not receive any message about this user
-    event, otherwise a dict containing information about the event.
+    Returns a dict containing information about the event.
     """
-    if socket.authenticated_userid != message['userid']:
-        return None
-
     # for session state change events, the full session model
     # is included so that clients can update themselves without
     # further API requests
@@ -194,14 +368,20 @@ def _generate_user_event(message, socket):
     }
 
 
-def _authorized_to_read(effective_principals, permissions):
+def _read_principals(permissions):
+    """
+    Return the set of pyramid principals allowed to read an annotation.
+
+    This is the same for every socket, so is computed once per message.
+    """
+    read_permissions = permissions.get('read', [])
+    return frozenset(translate_annotation_principals(read_permissions))
+
+
+def _authorized_to_read(effective_principals, read_principals):
     """Return True if the passed request is authorized to read the annotation.
 
     If the annotation belongs to a private group, this will return False if the
     authenticated user isn't a member of that group.
     """
-    read_permissions = permissions.get('read', [])
-    read_principals = translate_annotation_principals(read_permissions)
-    if set(read_principals).intersection(effective_principals):
-        return True
-    return False
+    return not read_principals.isdisjoint(effective_principals)
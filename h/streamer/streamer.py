@@ -4,6 +4,7 @@ import logging
 import sys
 
 import gevent
+from gevent.queue import Empty
 
 from h import db
 from h import stats
@@ -18,12 +19,28 @@ log = logging.getLogger(__name__)
 # The maxsize ensures that memory used by this queue is bounded. Producers
 # writing to the queue must consider their behaviour when the queue is full,
 # using .put(...) with a timeout or .put_nowait(...) as appropriate.
-WORK_QUEUE = gevent.queue.Queue(maxsize=4096)
+#
+# The default maxsize can be overridden with the `h.streamer.work_queue_size`
+# setting.
+WORK_QUEUE_SIZE = 4096
+WORK_QUEUE = gevent.queue.Queue(maxsize=WORK_QUEUE_SIZE)
+
+# The maximum number of messages from the message queues that are handled
+# together as a single batch
+BATCH_SIZE = 64
 
 # Message queues that the streamer processes messages from
 ANNOTATION_TOPIC = 'annotation'
 USER_TOPIC = 'user'
 
+# The handler for the messages from each message queue. The streamer only
+# subscribes to the message queues listed here, so every message it receives
+# has a handler.
+TOPIC_HANDLERS = {
+    ANNOTATION_TOPIC: messages.handle_annotation_events,
+    USER_TOPIC: messages.handle_user_events,
+}
+
 
 class UnknownMessageType(Exception):
     """Raised if a message in the work queue if of an unknown type."""
@@ -38,16 +55,13 @@ def start(event):
     The function does not block.
     """
     settings = event.app.registry.settings
+    WORK_QUEUE.maxsize = int(settings.get('h.streamer.work_queue_size',
+                                          WORK_QUEUE_SIZE))
     greenlets = [
         # Start greenlets to process messages from RabbitMQ
-        gevent.spawn(messages.process_messages,
-                     settings,
-                     ANNOTATION_TOPIC,
-                     WORK_QUEUE),
-        gevent.spawn(messages.process_messages,
-                     settings,
-                     USER_TOPIC,
-                     WORK_QUEUE),
+        gevent.spawn(messages.process_messages, settings, topic, WORK_QUEUE)
+        for topic in sorted(TOPIC_HANDLERS)
+    ] + [
         # A greenlet to periodically report to statsd
         gevent.spawn(report_stats, settings),
         # And one to process the queued work
@@ -64,20 +78,26 @@ def process_work_queue(settings, queue, session_factory=None):
     Process each message from the queue in turn, handling exceptions.
 
     This is the core of the streamer: we pull messages off the work queue,
-    dispatching them as appropriate. The handling of each message is wrapped in
-    code that ensures the database session is appropriately committed and
-    closed between messages.
+    dispatching them as appropriate. The handling of each message, or batch
+    of messages, is wrapped in code that ensures the database session is
+    appropriately committed and closed between them.
+
+    Messages from the message queues which are already waiting on the work
+    queue are handled together in batches of up to `BATCH_SIZE`, so that
+    bursts of activity share the per-message overhead. Failures handling
+    individual messages in a batch are caught and logged by
+    :py:func:`h.streamer.messages.handle_messages`, so that they don't lose
+    the rest of the batch.
     """
     if session_factory is None:
         session_factory = _get_session
     s = stats.get_client(settings).pipeline()
     session = session_factory(settings)
-    topic_handlers = {
-        ANNOTATION_TOPIC: messages.handle_annotation_event,
-        USER_TOPIC: messages.handle_user_event,
-    }
+    topic_handlers = TOPIC_HANDLERS
 
     for msg in queue:
+        # N.B. For messages from the message queues, this and the
+        # handler_message timer measure a whole batch of messages.
         t_total = s.timer('streamer.msg.handler_total')
         t_total.start()
         try:
@@ -89,8 +109,12 @@ def process_work_queue(settings, queue, session_factory=None):
                             "DEFERRABLE")
 
             if isinstance(msg, messages.Message):
+                batch = [msg] + _take_realtime_messages(queue, BATCH_SIZE - 1)
                 with s.timer('streamer.msg.handler_message'):
-                    messages.handle_message(msg, session, topic_handlers)
+                    messages.handle_messages(batch,
+                                             session,
+                                             topic_handlers,
+                                             s)
             elif isinstance(msg, websocket.Message):
                 with s.timer('streamer.msg.handler_websocket'):
                     websocket.handle_message(msg, session)
@@ -135,6 +159,25 @@ def supervise(greenlets):
     sys.exit(1)
 
 
+def _take_realtime_messages(queue, limit):
+    """
+    Remove and return messages from the message queues waiting in `queue`.
+
+    Takes up to `limit` messages from the head of the queue without blocking,
+    stopping at the first item that isn't a message from the message queues.
+    """
+    batch = []
+    while len(batch) < limit:
+        try:
+            msg = queue.peek_nowait()
+        except Empty:
+            break
+        if not isinstance(msg, messages.Message):
+            break
+        batch.append(queue.get_nowait())
+    return batch
+
+
 def _get_session(settings):
     engine = db.make_engine(settings)
     return db.Session(bind=engine)
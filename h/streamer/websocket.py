@@ -23,6 +23,13 @@ class WebSocket(_WebSocket):
     instances = weakref.WeakSet()
     origins = []
 
+    # A cached tuple of the open websockets. See `snapshot()`.
+    _snapshot = None
+
+    # The open websockets of logged-in users, keyed by userid, so that events
+    # for a single user don't have to be checked against every websocket.
+    instances_by_userid = {}
+
     # Instance attributes
     client_id = None
     filter = None
@@ -37,15 +44,59 @@ class WebSocket(_WebSocket):
 
         self.authenticated_userid = environ['h.ws.authenticated_userid']
         self.effective_principals = environ['h.ws.effective_principals']
+        # The principals are fixed for the lifetime of the connection, so
+        # build the set we check annotation permissions against only once.
+        self.effective_principals_set = frozenset(self.effective_principals)
         self.registry = environ['h.ws.registry']
 
+        if self.authenticated_userid is not None:
+            user_instances = self.instances_by_userid.setdefault(
+                self.authenticated_userid, weakref.WeakSet())
+            user_instances.add(self)
+
         self._work_queue = environ['h.ws.streamer_work_queue']
 
     def __new__(cls, *args, **kwargs):
         instance = super(WebSocket, cls).__new__(cls, *args, **kwargs)
         cls.instances.add(instance)
+        WebSocket._snapshot = None
         return instance
 
+    @classmethod
+    def snapshot(cls):
+        """
+        Return a tuple of all the open websockets.
+
+        Unlike `instances`, the returned tuple is safe to iterate over while
+        websockets are being opened and closed. It is only rebuilt after a
+        websocket has been opened or closed, rather than every time it is
+        asked for.
+
+        N.B. The cached tuple holds strong references to the websockets in
+        it. A websocket which is dropped without `closed()` being called (for
+        example, because `__init__` raised after `__new__` registered it) is
+        therefore kept alive, and keeps being offered messages, until the
+        next websocket is opened or closed and the tuple is rebuilt. We
+        accept that rather than rebuilding the tuple for every message.
+        """
+        if cls._snapshot is None:
+            WebSocket._snapshot = tuple(cls.instances)
+        return cls._snapshot
+
+    @classmethod
+    def user_instances(cls, userid):
+        """
+        Return a tuple of the open websockets logged in as `userid`.
+
+        A websocket which is garbage collected without `closed()` being called
+        drops out of its user's set, but leaves the (now empty) set behind in
+        `instances_by_userid`. Such an entry is removed here when it is found.
+        """
+        user_instances = tuple(cls.instances_by_userid.get(userid, ()))
+        if not user_instances:
+            cls.instances_by_userid.pop(userid, None)
+        return user_instances
+
     def received_message(self, msg):
         try:
             self._work_queue.put(Message(socket=self, payload=msg.data),
@@ -59,10 +110,19 @@ class WebSocket(_WebSocket):
             self.instances.remove(self)
         except KeyError:
             pass
+        else:
+            WebSocket._snapshot = None
+
+        user_instances = self.instances_by_userid.get(self.authenticated_userid)
+        if user_instances is not None:
+            user_instances.discard(self)
+            if not user_instances:
+                del self.instances_by_userid[self.authenticated_userid]
 
-    def send_json(self, payload):
+    def send_raw(self, data):
+        """Send an already JSON-encoded message to the client."""
         if not self.terminated:
-            self.send(json.dumps(payload))
+            self.send(data)
 
 
 def handle_message(message, session=None):
@@ -166,13 +166,17 @@ class TestHandleFormSubmission(object):
 
     def test_it_calls_validate(self, pyramid_request):
         form_ = mock.Mock(spec_set=['validate'])
+        pyramid_request.POST['name'] = 'Frank'
 
         form.handle_form_submission(pyramid_request,
                                     form_,
                                     mock_callable(),
                                     mock.sentinel.on_failure)
 
-        form_.validate.assert_called_once_with(pyramid_request.POST.items())
+        assert form_.validate.call_count == 1
+        controls = form_.validate.call_args[0][0]
+        assert not isinstance(controls, list)
+        assert list(controls) == list(pyramid_request.POST.items())
 
     def test_if_validation_fails_it_calls_on_failure(self,
                                                      pyramid_request,
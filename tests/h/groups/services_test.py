@@ -4,6 +4,7 @@ from __future__ import unicode_literals
 
 import mock
 import pytest
+import sqlalchemy as sa
 
 from h.models import Group
 from h.groups.services import GroupsService
@@ -86,6 +87,27 @@ class TestGroupsService(object):
 
         assert group.members.count(users['theresa']) == 1
 
+    def test_member_join_adds_user_to_persisted_group_without_loading_members(self, db_session, users, persisted_group):
+        svc = GroupsService(db_session, users.get)
+
+        svc.member_join(persisted_group, 'cazimir')  # Already a member.
+        svc.member_join(persisted_group, 'theresa')
+        db_session.flush()
+
+        assert 'members' in sa.inspect(persisted_group).unloaded
+        assert Group.is_member(db_session, persisted_group.id, users['theresa'].id)
+
+    def test_member_join_uses_loaded_user_groups(self, db_session, users, persisted_group):
+        svc = GroupsService(db_session, users.get)
+        db_session.expire(users['cazimir'], ['groups'])
+        assert persisted_group in users['cazimir'].groups
+
+        with mock.patch.object(Group, 'is_member') as is_member:
+            svc.member_join(persisted_group, 'cazimir')
+
+        assert not is_member.called
+        assert 'members' in sa.inspect(persisted_group).unloaded
+
     def test_member_join_publishes_join_event(self, db_session, users):
         publish = mock.Mock(spec_set=[])
         svc = GroupsService(db_session, users.get, publish=publish)
@@ -115,6 +137,16 @@ class TestGroupsService(object):
 
         assert users['cazimir'] not in group.members
 
+    def test_member_leave_removes_user_from_persisted_group_without_loading_members(self, db_session, users, persisted_group):
+        svc = GroupsService(db_session, users.get)
+
+        svc.member_leave(persisted_group, 'theresa')  # Not a member.
+        svc.member_leave(persisted_group, 'cazimir')
+        db_session.flush()
+
+        assert 'members' in sa.inspect(persisted_group).unloaded
+        assert not Group.is_member(db_session, persisted_group.id, users['cazimir'].id)
+
     def test_member_leave_publishes_leave_event(self, db_session, users):
         publish = mock.Mock(spec_set=[])
         svc = GroupsService(db_session, users.get, publish=publish)
@@ -162,6 +194,16 @@ class TestGroupsFactory(object):
         })
 
 
+@pytest.fixture
+def persisted_group(db_session, users):
+    """Return a flushed group, created by cazimir, with members unloaded."""
+    group = Group(name='Donkey Trust', creator=users['cazimir'])
+    db_session.add(group)
+    db_session.flush()
+    db_session.expire(group, ['members'])
+    return group
+
+
 @pytest.fixture
 def user_service(pyramid_config):
     service = mock.Mock(spec_set=['fetch'])
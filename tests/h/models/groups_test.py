@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import pytest
+import sqlalchemy
 
 from pyramid import security
 
@@ -75,6 +76,24 @@ def test_created_by(db_session, factories):
     assert models.Group.created_by(db_session, user).all() == [group_1, group_2]
 
 
+def test_is_member_returns_true_for_members(db_session, factories):
+    user = factories.User()
+    group = models.Group(name="My Hypothesis Group", creator=user)
+    db_session.add(group)
+    db_session.flush()
+
+    assert models.Group.is_member(db_session, group.id, user.id) is True
+
+
+def test_is_member_returns_false_for_non_members(db_session, factories):
+    user = factories.User()
+    group = models.Group(name="My Hypothesis Group", creator=factories.User())
+    db_session.add(group)
+    db_session.flush()
+
+    assert models.Group.is_member(db_session, group.id, user.id) is False
+
+
 @pytest.mark.usefixtures('documents')
 def test_documents_returns_groups_annotated_documents(db_session, group):
     # Three different documents each with a shared annotation in the group.
@@ -163,6 +182,28 @@ def test_acl(group, factories):
     ]
 
 
+class TestGroupFactory(object):
+    def test_it_returns_the_group(self, db_session, factories, pyramid_request):
+        group = factories.Group()
+        db_session.flush()
+
+        assert models.group.GroupFactory(pyramid_request)[group.pubid] == group
+
+    def test_it_loads_the_group_creator(self, db_session, factories,
+                                        pyramid_request):
+        group = factories.Group()
+        db_session.flush()
+        db_session.expunge_all()
+
+        group = models.group.GroupFactory(pyramid_request)[group.pubid]
+
+        assert 'creator' not in sqlalchemy.inspect(group).unloaded
+
+    def test_it_raises_KeyError_for_unknown_pubid(self, pyramid_request):
+        with pytest.raises(KeyError):
+            models.group.GroupFactory(pyramid_request)['does-not-exist']
+
+
 def annotation(session, document_, groupid, shared):
     """Add a new annotation of the given document to the db and return it."""
     annotation_ = memex.models.Annotation(
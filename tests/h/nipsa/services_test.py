@@ -28,6 +28,29 @@ class TestNipsaService(object):
         assert not svc.is_flagged('acct:dominic@example.com')
         assert not svc.is_flagged('acct:romeo@example.com')
 
+    def test_flagged_userids_returns_the_flagged_userids(self, db_session):
+        svc = NipsaService(db_session)
+
+        flagged = svc.flagged_userids(['acct:renata@example.com',
+                                       'acct:dominic@example.com',
+                                       'acct:romeo@example.com'])
+
+        assert flagged == set(['acct:renata@example.com'])
+
+    def test_flagged_userids_ignores_invalid_userids(self, db_session):
+        svc = NipsaService(db_session)
+
+        flagged = svc.flagged_userids([None,
+                                       'not a userid',
+                                       'acct:cecilia@example.com'])
+
+        assert flagged == set(['acct:cecilia@example.com'])
+
+    def test_flagged_userids_returns_empty_set_for_no_userids(self, db_session):
+        svc = NipsaService(db_session)
+
+        assert svc.flagged_userids([]) == set()
+
     def test_flag_sets_nipsa_true(self, db_session, users):
         svc = NipsaService(db_session)
 
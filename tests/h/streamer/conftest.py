@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+import pytest
+
+
+@pytest.fixture
+def instances_by_userid(monkeypatch):
+    """Replace the websockets-by-userid index with an empty one."""
+    instances = {}
+    monkeypatch.setattr('h.streamer.websocket.WebSocket.instances_by_userid',
+                        instances)
+    return instances
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+import json
+
 import mock
 import pytest
 from gevent.queue import Queue
@@ -7,6 +9,7 @@ from pyramid import security
 from pyramid import registry
 
 from h.streamer import messages
+from memex.db.types import InvalidUUID
 
 
 class FakeSocket(object):
@@ -25,10 +28,14 @@ class FakeSocket(object):
         self.registry = registry.Registry('streamer_test')
         self.registry.settings = {'h.app_url': 'http://streamer'}
 
-        self.send_json_payloads = []
+        self.sent_payloads = []
+
+    @property
+    def effective_principals_set(self):
+        return frozenset(self.effective_principals)
 
-    def send_json(self, payload):
-        self.send_json_payloads.append(payload)
+    def send_raw(self, data):
+        self.sent_payloads.append(json.loads(data))
 
 
 @pytest.mark.usefixtures('fake_sentry', 'fake_stats')
@@ -95,6 +102,36 @@ class TestProcessMessages(object):
         consumer = fake_consumer.return_value
         consumer.run.assert_called_once_with()
 
+    def test_creates_handler_pool_with_default_size(self, fake_consumer, fake_pool, queue):
+        messages.process_messages({}, 'foobar', queue, raise_error=False)
+
+        fake_pool.assert_called_once_with(size=messages.HANDLER_POOL_SIZE)
+
+    def test_creates_handler_pool_with_size_from_settings(self, fake_consumer, fake_pool, queue):
+        settings = {'h.streamer.handler_pool_size': '4'}
+
+        messages.process_messages(settings, 'foobar', queue, raise_error=False)
+
+        fake_pool.assert_called_once_with(size=4)
+
+    def test_message_handler_puts_messages_from_handler_pool(self, fake_consumer, fake_pool, queue):
+        messages.process_messages({}, 'foobar', queue, raise_error=False)
+        message_handler = fake_consumer.call_args[1]['handler']
+        fake_pool.return_value.spawn.reset_mock()
+        fake_pool.return_value.spawn.side_effect = None
+
+        message_handler({'foo': 'bar'})
+
+        fake_pool.return_value.spawn.assert_called_once_with(mock.ANY,
+                                                             {'foo': 'bar'})
+        assert queue.empty()
+
+    def test_drains_handler_pool_when_consumer_stops(self, fake_consumer, fake_pool, queue):
+        messages.process_messages({}, 'foobar', queue, raise_error=False)
+
+        fake_pool.return_value.join.assert_called_once_with(
+            timeout=messages.HANDLER_POOL_JOIN_TIMEOUT)
+
     def test_message_handler_puts_message_on_queue(self, fake_consumer, queue):
         messages.process_messages({}, 'foobar', queue, raise_error=False)
         message_handler = fake_consumer.call_args[1]['handler']
@@ -104,6 +141,26 @@ class TestProcessMessages(object):
         assert result.topic == 'foobar'
         assert result.payload == {'foo': 'bar'}
 
+    def test_message_handler_times_queue_put(self, fake_consumer, fake_stats, queue):
+        messages.process_messages({}, 'foobar', queue, raise_error=False)
+        message_handler = fake_consumer.call_args[1]['handler']
+
+        message_handler({'foo': 'bar'})
+
+        statsd_client = fake_stats.get_client.return_value
+        statsd_client.timer.assert_called_once_with('streamer.handler.queue_put')
+
+    def test_message_handler_counts_messages_dropped_when_queue_full(self, fake_consumer, fake_stats):
+        queue = Queue(maxsize=1)
+        queue.put(mock.sentinel.message)
+        messages.process_messages({}, 'foobar', queue, raise_error=False)
+        message_handler = fake_consumer.call_args[1]['handler']
+
+        message_handler({'foo': 'bar'})
+
+        statsd_client = fake_stats.get_client.return_value
+        statsd_client.incr.assert_called_once_with('streamer.work_queue.full')
+
     @pytest.fixture
     def fake_sentry(self, patch):
         return patch('h.sentry')
@@ -116,6 +173,14 @@ class TestProcessMessages(object):
     def fake_consumer(self, patch):
         return patch('h.streamer.messages.Consumer')
 
+    @pytest.fixture(autouse=True)
+    def fake_pool(self, patch):
+        pool = patch('h.streamer.messages.Pool')
+        # Run spawned functions straight away, so that tests of the message
+        # handler don't have to wait for the greenlets to run.
+        pool.return_value.spawn.side_effect = lambda func, *args: func(*args)
+        return pool
+
     @pytest.fixture
     def fake_realtime(self, patch):
         return patch('h.streamer.messages.realtime')
@@ -125,25 +190,107 @@ class TestProcessMessages(object):
         return Queue()
 
 
-class TestHandleMessage(object):
-    def test_calls_handler_with_list_of_sockets(self, websocket):
+class TestHandleMessages(object):
+    def test_calls_handler_with_list_of_sockets(self, session, websocket, stats):
         handler = mock.Mock(return_value=None)
-        session = mock.sentinel.db_session
         message = messages.Message(topic='foo', payload={'foo': 'bar'})
-        websocket.instances = [FakeSocket('a'), FakeSocket('b')]
+        websocket.snapshot.return_value = (FakeSocket('a'), FakeSocket('b'))
+
+        messages.handle_messages([message], session, {'foo': handler}, stats)
+
+        handler.assert_called_once_with([message.payload],
+                                        websocket.snapshot.return_value,
+                                        session,
+                                        stats)
+
+    def test_calls_each_handler_once_with_payloads_for_its_topic(self, session, websocket, stats):
+        foo_handler = mock.Mock(return_value=None)
+        bar_handler = mock.Mock(return_value=None)
+        batch = [
+            messages.Message(topic='foo', payload='foo1'),
+            messages.Message(topic='bar', payload='bar1'),
+            messages.Message(topic='foo', payload='foo2'),
+        ]
+        websocket.snapshot.return_value = (FakeSocket('a'),)
+
+        messages.handle_messages(batch,
+                                 session,
+                                 {'foo': foo_handler, 'bar': bar_handler},
+                                 stats)
+
+        foo_handler.assert_called_once_with(['foo1', 'foo2'], mock.ANY, session, stats)
+        bar_handler.assert_called_once_with(['bar1'], mock.ANY, session, stats)
+
+    def test_handles_other_topics_when_a_handler_raises(self, log, session, websocket, stats):
+        foo_handler = mock.Mock(side_effect=RuntimeError('explosion'))
+        bar_handler = mock.Mock(return_value=None)
+        batch = [
+            messages.Message(topic='foo', payload='foo1'),
+            messages.Message(topic='bar', payload='bar1'),
+        ]
+
+        messages.handle_messages(batch,
+                                 session,
+                                 {'foo': foo_handler, 'bar': bar_handler},
+                                 stats)
+
+        bar_handler.assert_called_once_with(['bar1'], mock.ANY, session, stats)
+        assert log.exception.call_count == 1
+
+    def test_raises_KeyError_for_unknown_topic(self, session, websocket, stats):
+        handler = mock.Mock(return_value=None)
+        message = messages.Message(topic='unknown', payload={'foo': 'bar'})
 
-        messages.handle_message(message, session, topic_handlers={'foo': handler})
+        with pytest.raises(KeyError):
+            messages.handle_messages([message], session, {'foo': handler}, stats)
 
-        handler.assert_called_once_with(message.payload, list(websocket.instances), session)
+        assert not handler.called
+
+    @pytest.fixture
+    def log(self, patch):
+        return patch('h.streamer.messages.log')
+
+    @pytest.fixture
+    def session(self):
+        return mock.sentinel.db_session
 
     @pytest.fixture
     def websocket(self, patch):
         return patch('h.streamer.websocket.WebSocket')
 
 
-@pytest.mark.usefixtures('fetch_annotation', 'links_service', 'nipsa_service')
-class TestHandleAnnotationEvent(object):
-    def test_it_fetches_the_annotation(self, fetch_annotation, presenter_asdict):
+def test_handle_user_events_handles_each_event(patch, stats):
+    handle_user_event = patch('h.streamer.messages.handle_user_event')
+    session = mock.sentinel.db_session
+    sockets = [FakeSocket('a')]
+
+    messages.handle_user_events(['event1', 'event2'], sockets, session, stats)
+
+    assert handle_user_event.call_args_list == [
+        mock.call('event1'),
+        mock.call('event2'),
+    ]
+
+
+def test_handle_user_events_handles_other_events_when_one_raises(patch, stats):
+    log = patch('h.streamer.messages.log')
+    handle_user_event = patch('h.streamer.messages.handle_user_event')
+    handle_user_event.side_effect = [KeyError('userid'), None]
+    session = mock.sentinel.db_session
+    sockets = [FakeSocket('a')]
+
+    messages.handle_user_events(['event1', 'event2'], sockets, session, stats)
+
+    assert handle_user_event.call_count == 2
+    assert log.exception.call_count == 1
+
+
+@pytest.mark.usefixtures('fetch_ordered_annotations',
+                         'instances_by_userid',
+                         'links_service',
+                         'nipsa_service')
+class TestHandleAnnotationEvents(object):
+    def test_it_fetches_the_annotation(self, fetch_ordered_annotations, presenter_asdict, stats):
         message = {
             'annotation_id': 'panda',
             'action': 'update',
@@ -153,11 +300,64 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        fetch_ordered_annotations.assert_called_once_with(session, ['panda'])
+
+    def test_it_fetches_all_the_annotations_in_the_batch_at_once(self,
+                                                                 fetch_ordered_annotations,
+                                                                 presenter_asdict, stats):
+        batch = [
+            {'annotation_id': 'panda', 'action': 'update', 'src_client_id': '_'},
+            {'annotation_id': 'koala', 'action': 'create', 'src_client_id': '_'},
+        ]
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events(batch, [FakeSocket('giraffe')], session, stats)
+
+        fetch_ordered_annotations.assert_called_once_with(session, ['panda', 'koala'])
+
+    def test_it_checks_nipsa_flags_for_the_batch_at_once(self, nipsa_service, presenter_asdict, stats):
+        batch = [
+            {'annotation_id': 'panda', 'action': 'update', 'src_client_id': '_'},
+            {'annotation_id': 'koala', 'action': 'delete', 'src_client_id': '_',
+             'annotation_dict': self.serialized_annotation({'user': 'geraldine'})},
+        ]
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events(batch, [FakeSocket('giraffe')], session, stats)
+
+        nipsa_service.assert_called_once_with(session)
+        nipsa_service.return_value.flagged_userids.assert_called_once_with(
+            ['fred', 'geraldine'])
+
+    def test_it_fetches_annotations_separately_if_an_id_is_invalid(self,
+                                                                   annotation,
+                                                                   fetch_annotation,
+                                                                   fetch_ordered_annotations,
+                                                                   presenter_asdict, stats):
+        batch = [
+            {'annotation_id': 'invalid', 'action': 'update', 'src_client_id': '_'},
+            {'annotation_id': 'panda', 'action': 'update', 'src_client_id': '_'},
+        ]
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        fetch_ordered_annotations.side_effect = InvalidUUID()
+        annotation.id = 'panda'
+        fetch_annotation.side_effect = [None, annotation]
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events(batch, [socket], session, stats)
 
-        fetch_annotation.assert_called_once_with(session, 'panda')
+        assert fetch_annotation.call_args_list == [
+            mock.call(session, 'invalid'),
+            mock.call(session, 'panda'),
+        ]
+        assert len(socket.sent_payloads) == 1
 
-    def test_it_skips_notification_when_fetch_failed(self, fetch_annotation):
+    def test_it_skips_notification_when_fetch_failed(self, fetch_ordered_annotations, stats):
         """
         When a create/update and a delete event happens in quick succession
         we could fail to load the annotation, even though the event action is
@@ -171,30 +371,64 @@ class TestHandleAnnotationEvent(object):
         }
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
-        fetch_annotation.return_value = None
+        fetch_ordered_annotations.side_effect = lambda session, ids: []
 
-        result = messages.handle_annotation_event(message, [socket], session)
+        result = messages.handle_annotation_events([message], [socket], session, stats)
 
         assert result is None
 
     def test_it_serializes_the_annotation(self,
-                                          fetch_annotation,
+                                          annotation,
                                           links_service,
-                                          presenters):
+                                          presenters, stats):
         message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
         presenters.AnnotationJSONPresenter.return_value.asdict.return_value = (
             self.serialized_annotation())
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
         presenters.AnnotationJSONPresenter.assert_called_once_with(
-            fetch_annotation.return_value,
+            annotation,
             links_service.return_value)
         assert presenters.AnnotationJSONPresenter.return_value.asdict.called
 
-    def test_notification_format(self, presenter_asdict):
+    def test_it_serializes_the_annotation_once_for_all_sockets(self, presenters, stats):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('elephant')]
+        session = mock.sentinel.db_session
+        presenters.AnnotationJSONPresenter.return_value.asdict.return_value = (
+            self.serialized_annotation())
+
+        messages.handle_annotation_events([message], sockets, session, stats)
+
+        assert presenters.AnnotationJSONPresenter.call_count == 1
+        for socket in sockets:
+            assert len(socket.sent_payloads) == 1
+
+    def test_it_uses_the_socket_registry_for_links(self, links_service, presenter_asdict, stats):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        links_service.assert_called_once_with('http://streamer', socket.registry)
+
+    def test_it_reuses_the_links_service_between_events(self, links_service, presenter_asdict, stats):
+        message = {'action': '_', 'annotation_id': '_', 'src_client_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], [socket], session, stats)
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert links_service.call_count == 1
+
+    def test_notification_format(self, presenter_asdict, stats):
         """Check the format of the returned notification in the happy case."""
         message = {
             'annotation_id': 'panda',
@@ -205,26 +439,26 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads[0] == {
+        assert socket.sent_payloads[0] == {
             'payload': [self.serialized_annotation()],
             'type': 'annotation-notification',
             'options': {'action': 'update'},
         }
 
-    def test_no_send_for_sender_socket(self, presenter_asdict):
+    def test_no_send_for_sender_socket(self, presenter_asdict, stats):
         """Should return None if the socket's client_id matches the message's."""
         message = {'src_client_id': 'pigeon', 'annotation_id': '_', 'action': '_'}
         socket = FakeSocket('pigeon')
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert socket.sent_payloads == []
 
-    def test_no_send_if_no_socket_filter(self, presenter_asdict):
+    def test_no_send_if_no_socket_filter(self, presenter_asdict, stats):
         """Should return None if the socket has no filter."""
         message = {'src_client_id': '_', 'annotation_id': '_', 'action': '_'}
         socket = FakeSocket('giraffe')
@@ -232,22 +466,57 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert socket.sent_payloads == []
 
-        assert socket.send_json_payloads == []
+    def test_no_send_if_socket_filter_does_not_accept_action(self, presenter_asdict, stats):
+        message = {'src_client_id': '_', 'annotation_id': '_', 'action': 'delete',
+                   'annotation_dict': self.serialized_annotation()}
+        socket = FakeSocket('giraffe')
+        socket.filter.match_action.return_value = False
+        session = mock.sentinel.db_session
+
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-    def test_no_send_if_action_is_read(self, presenter_asdict):
+        socket.filter.match_action.assert_called_once_with('delete')
+        assert not socket.filter.match.called
+        assert socket.sent_payloads == []
+
+    def test_it_checks_each_socket_filter_once_per_action(self, presenter_asdict, stats):
+        batch = [
+            {'annotation_id': 'panda', 'action': 'update', 'src_client_id': '_'},
+            {'annotation_id': 'koala', 'action': 'update', 'src_client_id': '_'},
+        ]
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events(batch, [socket], session, stats)
+
+        socket.filter.match_action.assert_called_once_with('update')
+
+    def test_no_send_if_action_is_read(self, presenter_asdict, stats):
         """Should return None if the message action is 'read'."""
         message = {'action': 'read', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert socket.sent_payloads == []
+
+    def test_it_does_not_fetch_the_annotation_if_action_is_read(self, fetch_ordered_annotations, stats):
+        message = {'action': 'read', 'src_client_id': '_', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert not fetch_ordered_annotations.called
 
-    def test_no_send_if_filter_does_not_match(self, presenter_asdict):
+    def test_no_send_if_filter_does_not_match(self, presenter_asdict, stats):
         """Should return None if the socket filter doesn't match the message."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
@@ -255,23 +524,23 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert socket.sent_payloads == []
 
-    def test_no_send_if_annotation_nipsad(self, nipsa_service, presenter_asdict):
+    def test_no_send_if_annotation_nipsad(self, nipsa_service, presenter_asdict, stats):
         """Should return None if the annotation is from a NIPSA'd user."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        nipsa_service.return_value.flagged_userids.return_value = set(['fred'])
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert socket.sent_payloads == []
 
-    def test_no_send_if_annotation_delete_nipsad(self, fetch_annotation, nipsa_service):
+    def test_no_send_if_annotation_delete_nipsad(self, fetch_ordered_annotations, nipsa_service, stats):
         """
         Should return None if the annotation is a deletion from a NIPSA'd
         user.
@@ -282,31 +551,30 @@ class TestHandleAnnotationEvent(object):
             'annotation_id': '_',
             'annotation_dict': self.serialized_annotation({'user': 'geraldine'}),
         }
-        fetch_annotation.return_value = None
+        fetch_ordered_annotations.side_effect = lambda session, ids: []
         socket = FakeSocket('giraffe')
         session = mock.sentinel.db_session
-        def is_flagged(userid):
-            return userid == 'geraldine'
-        nipsa_service.return_value.is_flagged.side_effect = is_flagged
+        nipsa_service.return_value.flagged_userids.return_value = set(['geraldine'])
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert socket.sent_payloads == []
 
-    def test_sends_nipsad_annotations_to_owners(self, nipsa_service, presenter_asdict):
+    def test_sends_nipsad_annotations_to_owners(self, instances_by_userid, nipsa_service, presenter_asdict, stats):
         """NIPSA'd users should see their own annotations."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
         socket.authenticated_userid = 'fred'
+        instances_by_userid['fred'] = [socket]
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
-        nipsa_service.return_value.is_flagged.return_value = True
+        nipsa_service.return_value.flagged_userids.return_value = set(['fred'])
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert len(socket.send_json_payloads) == 1
+        assert len(socket.sent_payloads) == 1
 
-    def test_sends_nipsad_deletes_to_owners(self, fetch_annotation, nipsa_service):
+    def test_sends_nipsad_deletes_to_owners(self, fetch_ordered_annotations, instances_by_userid, nipsa_service, stats):
         """NIPSA'd users should see their own deletions."""
         message = {
             'action': 'delete',
@@ -314,19 +582,49 @@ class TestHandleAnnotationEvent(object):
             'annotation_id': '_',
             'annotation_dict': self.serialized_annotation({'user': 'geraldine'}),
         }
-        fetch_annotation.return_value = None
+        fetch_ordered_annotations.side_effect = lambda session, ids: []
         socket = FakeSocket('giraffe')
         socket.authenticated_userid = 'geraldine'
+        instances_by_userid['geraldine'] = [socket]
         session = mock.sentinel.db_session
-        def is_flagged(userid):
-            return userid == 'geraldine'
-        nipsa_service.return_value.is_flagged.side_effect = is_flagged
+        nipsa_service.return_value.flagged_userids.return_value = set(['geraldine'])
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert len(socket.send_json_payloads) == 1
+        assert len(socket.sent_payloads) == 1
 
-    def test_sends_if_annotation_public(self, presenter_asdict):
+    def test_sends_nipsad_annotations_only_to_the_owners_sockets(self, instances_by_userid, nipsa_service, presenter_asdict, stats):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        owner_socket = FakeSocket('giraffe')
+        owner_socket.authenticated_userid = 'fred'
+        other_socket = FakeSocket('elephant')
+        instances_by_userid['fred'] = [owner_socket]
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+        nipsa_service.return_value.flagged_userids.return_value = set(['fred'])
+
+        messages.handle_annotation_events([message],
+                                          [owner_socket, other_socket],
+                                          session,
+                                          stats)
+
+        assert len(owner_socket.sent_payloads) == 1
+        assert not other_socket.filter.match.called
+
+    def test_no_send_of_nipsad_annotations_to_owners_sockets_not_in_the_batch(self, instances_by_userid, nipsa_service, presenter_asdict, stats):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        socket.authenticated_userid = 'fred'
+        instances_by_userid['fred'] = [socket]
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+        nipsa_service.return_value.flagged_userids.return_value = set(['fred'])
+
+        messages.handle_annotation_events([message], [], session, stats)
+
+        assert socket.sent_payloads == []
+
+    def test_sends_if_annotation_public(self, presenter_asdict, stats):
         """
         Everyone should see annotations which are public.
 
@@ -341,11 +639,11 @@ class TestHandleAnnotationEvent(object):
         session = mock.sentinel.db_session
         presenter_asdict.return_value = self.serialized_annotation()
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert len(socket.send_json_payloads) == 1
+        assert len(socket.sent_payloads) == 1
 
-    def test_no_send_if_not_in_group(self, presenter_asdict):
+    def test_no_send_if_not_in_group(self, presenter_asdict, stats):
         """Users shouldn't see annotations in groups they aren't members of."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
@@ -354,11 +652,11 @@ class TestHandleAnnotationEvent(object):
         presenter_asdict.return_value = self.serialized_annotation({
             'permissions': {'read': ['group:private-group']}})
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
 
-        assert socket.send_json_payloads == []
+        assert socket.sent_payloads == []
 
-    def test_sends_if_in_group(self, presenter_asdict):
+    def test_sends_if_in_group(self, presenter_asdict, stats):
         """Users should see annotations in groups they are members of."""
         message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
         socket = FakeSocket('giraffe')
@@ -368,9 +666,97 @@ class TestHandleAnnotationEvent(object):
         presenter_asdict.return_value = self.serialized_annotation({
             'permissions': {'read': ['group:private-group']}})
 
-        messages.handle_annotation_event(message, [socket], session)
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert len(socket.sent_payloads) == 1
+
+    def test_it_translates_read_permissions_once_for_all_sockets(self, patch, presenter_asdict, stats):
+        translate = patch('h.streamer.messages.translate_annotation_principals')
+        translate.return_value = [security.Everyone]
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('elephant')]
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], sockets, session, stats)
+
+        translate.assert_called_once_with(['group:__world__'])
+        for socket in sockets:
+            assert len(socket.sent_payloads) == 1
+
+    def test_it_sends_the_other_events_in_the_batch_when_one_raises(self, fetch_ordered_annotations, patch, presenter_asdict, stats):
+        log = patch('h.streamer.messages.log')
+        fetch_ordered_annotations.side_effect = lambda session, ids: [
+            mock.Mock(spec_set=['id', 'userid'], id=id_, userid='fred')
+            for id_ in ids]
+        batch = [
+            {'action': 'create', 'src_client_id': '_', 'annotation_id': 'bad'},
+            {'action': 'create', 'src_client_id': '_', 'annotation_id': 'good'},
+        ]
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.side_effect = [RuntimeError('explosion'),
+                                        self.serialized_annotation()]
 
-        assert len(socket.send_json_payloads) == 1
+        messages.handle_annotation_events(batch, [socket], session, stats)
+
+        assert len(socket.sent_payloads) == 1
+        assert log.exception.call_count == 1
+
+    def test_it_does_not_check_socket_principals_for_public_annotations(self, patch, presenter_asdict, stats):
+        authorized_to_read = patch('h.streamer.messages._authorized_to_read')
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert not authorized_to_read.called
+        assert len(socket.sent_payloads) == 1
+
+    def test_it_times_serialization_and_fanout(self, presenter_asdict, stats):
+        message = {'action': '_', 'src_client_id': '_', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert stats.timer.call_args_list == [
+            mock.call('streamer.annotation.serialize'),
+            mock.call('streamer.annotation.fanout'),
+        ]
+
+    def test_it_encodes_the_notification_once_for_all_sockets(self, patch, presenter_asdict, stats):
+        json_ = patch('h.streamer.messages.json')
+        message = {'action': 'create', 'src_client_id': '_', 'annotation_id': '_'}
+        sockets = [FakeSocket('giraffe'), FakeSocket('elephant')]
+        for socket in sockets:
+            socket.send_raw = mock.Mock()
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], sockets, session, stats)
+
+        json_.dumps.assert_called_once_with({
+            'type': 'annotation-notification',
+            'options': {'action': 'create'},
+            'payload': [presenter_asdict.return_value],
+        })
+        for socket in sockets:
+            socket.send_raw.assert_called_once_with(json_.dumps.return_value)
+
+    def test_it_does_not_encode_the_notification_if_no_socket_receives_it(self, patch, presenter_asdict, stats):
+        json_ = patch('h.streamer.messages.json')
+        message = {'action': '_', 'src_client_id': 'giraffe', 'annotation_id': '_'}
+        socket = FakeSocket('giraffe')
+        session = mock.sentinel.db_session
+        presenter_asdict.return_value = self.serialized_annotation()
+
+        messages.handle_annotation_events([message], [socket], session, stats)
+
+        assert not json_.dumps.called
 
     def serialized_annotation(self, data=None):
         if data is None:
@@ -384,6 +770,22 @@ class TestHandleAnnotationEvent(object):
 
         return serialized
 
+    @pytest.fixture
+    def annotation(self):
+        return mock.Mock(spec_set=['id', 'userid'], userid='fred')
+
+    @pytest.fixture
+    def fetch_ordered_annotations(self, patch, annotation):
+        fetch_ordered_annotations = patch(
+            'h.streamer.messages.storage.fetch_ordered_annotations')
+
+        def fetch(session, ids):
+            annotation.id = ids[0]
+            return [annotation]
+
+        fetch_ordered_annotations.side_effect = fetch
+        return fetch_ordered_annotations
+
     @pytest.fixture
     def fetch_annotation(self, patch):
         return patch('h.streamer.messages.storage.fetch_annotation')
@@ -403,13 +805,14 @@ class TestHandleAnnotationEvent(object):
     @pytest.fixture
     def nipsa_service(self, patch):
         service = patch('h.streamer.messages.NipsaService')
-        service.return_value.is_flagged.return_value = False
+        service.return_value.flagged_userids.return_value = set()
         return service
 
 
+@pytest.mark.usefixtures('instances_by_userid')
 class TestHandleUserEvent(object):
-    def test_sends_session_change_when_joining_or_leaving_group(self):
-        session_model = mock.Mock()
+    def test_sends_session_change_when_joining_or_leaving_group(self, instances_by_userid):
+        session_model = {'groups': ['groupid']}
         message = {
             'type': 'group-join',
             'userid': 'amy',
@@ -418,16 +821,41 @@ class TestHandleUserEvent(object):
         }
         socket = FakeSocket('clientid')
         socket.authenticated_userid = 'amy'
+        instances_by_userid['amy'] = [socket]
 
-        messages.handle_user_event(message, [socket], None)
+        messages.handle_user_event(message)
 
-        assert socket.send_json_payloads[0] == {
+        assert socket.sent_payloads[0] == {
             'type': 'session-change',
             'action': 'group-join',
             'model': session_model,
         }
 
-    def test_no_send_when_socket_is_not_event_users(self):
+    def test_encodes_the_session_change_once_for_all_sockets(self, instances_by_userid, patch):
+        json_ = patch('h.streamer.messages.json')
+        message = {
+            'type': 'group-join',
+            'userid': 'amy',
+            'group': 'groupid',
+            'session_model': {},
+        }
+        sockets = [FakeSocket('clientid'), FakeSocket('otherid')]
+        for socket in sockets:
+            socket.authenticated_userid = 'amy'
+            socket.send_raw = mock.Mock()
+        instances_by_userid['amy'] = sockets
+
+        messages.handle_user_event(message)
+
+        json_.dumps.assert_called_once_with({
+            'type': 'session-change',
+            'action': 'group-join',
+            'model': {},
+        })
+        for socket in sockets:
+            socket.send_raw.assert_called_once_with(json_.dumps.return_value)
+
+    def test_no_send_when_socket_is_not_event_users(self, instances_by_userid):
         """Don't send session-change events if the event user is not the socket user."""
         message = {
             'type': 'group-join',
@@ -436,7 +864,32 @@ class TestHandleUserEvent(object):
         }
         socket = FakeSocket('clientid')
         socket.authenticated_userid = 'bob'
+        instances_by_userid['bob'] = [socket]
+
+        messages.handle_user_event(message)
+
+        assert socket.sent_payloads == []
+
+    def test_only_looks_at_the_event_users_sockets(self, instances_by_userid):
+        message = {
+            'type': 'group-join',
+            'userid': 'amy',
+            'group': 'groupid',
+            'session_model': {},
+        }
+        amy_socket = FakeSocket('clientid')
+        amy_socket.authenticated_userid = 'amy'
+        other_socket = FakeSocket('otherid')
+        other_socket.authenticated_userid = 'bob'
+        instances_by_userid['amy'] = [amy_socket]
+        instances_by_userid['bob'] = [other_socket]
+
+        messages.handle_user_event(message)
+
+        assert len(amy_socket.sent_payloads) == 1
+        assert other_socket.sent_payloads == []
 
-        messages.handle_user_event(message, [socket], None)
 
-        assert socket.send_json_payloads == []
+@pytest.fixture
+def stats():
+    return mock.MagicMock(spec_set=['timer'])
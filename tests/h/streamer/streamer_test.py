@@ -3,44 +3,104 @@
 import mock
 from mock import call
 import pytest
+from gevent.queue import Queue
 
 from h.streamer import messages
 from h.streamer import streamer
 from h.streamer import websocket
 
 
-def test_process_work_queue_sends_realtime_messages_to_messages_handle_message(session):
+def test_process_work_queue_sends_realtime_messages_to_messages_handle_messages(session):
     message = messages.Message(topic='foo', payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
-    messages.handle_message.assert_called_once_with(message,
-                                                    session,
-                                                    topic_handlers=mock.ANY)
+    messages.handle_messages.assert_called_once_with([message],
+                                                     session,
+                                                     topic_handlers=mock.ANY,
+                                                     stats=mock.ANY)
+
+
+def test_process_work_queue_batches_waiting_realtime_messages(session):
+    message1 = messages.Message(topic='foo', payload='bar')
+    message2 = messages.Message(topic='user', payload='baz')
+    queue = work_queue(message1, message2)
+
+    streamer.process_work_queue({}, queue, session_factory=lambda _: session)
+
+    messages.handle_messages.assert_called_once_with([message1, message2],
+                                                     session,
+                                                     topic_handlers=mock.ANY,
+                                                     stats=mock.ANY)
+    assert session.commit.call_count == 1
+
+
+def test_process_work_queue_passes_stats_pipeline_to_handle_messages(patch, session):
+    stats = patch('h.streamer.streamer.stats')
+    message = messages.Message(topic='foo', payload='bar')
+    queue = work_queue(message)
+
+    streamer.process_work_queue({}, queue, session_factory=lambda _: session)
+
+    pipeline = stats.get_client.return_value.pipeline.return_value
+    messages.handle_messages.assert_called_once_with(mock.ANY,
+                                                     session,
+                                                     topic_handlers=mock.ANY,
+                                                     stats=pipeline)
+
+
+def test_process_work_queue_limits_batch_size(session, monkeypatch):
+    monkeypatch.setattr(streamer, 'BATCH_SIZE', 2)
+    batch1 = [messages.Message(topic='foo', payload=str(i)) for i in range(2)]
+    batch2 = [messages.Message(topic='foo', payload='2')]
+    queue = work_queue(*(batch1 + batch2))
+
+    streamer.process_work_queue({}, queue, session_factory=lambda _: session)
+
+    assert messages.handle_messages.call_args_list == [
+        call(batch1, session, mock.ANY, mock.ANY),
+        call(batch2, session, mock.ANY, mock.ANY),
+    ]
+
+
+def test_process_work_queue_does_not_batch_past_websocket_messages(session):
+    message1 = messages.Message(topic='foo', payload='bar')
+    message2 = websocket.Message(socket=mock.sentinel.SOCKET, payload='bar')
+    message3 = messages.Message(topic='foo', payload='baz')
+    queue = work_queue(message1, message2, message3)
+
+    streamer.process_work_queue({}, queue, session_factory=lambda _: session)
+
+    assert messages.handle_messages.call_args_list == [
+        call([message1], session, mock.ANY, mock.ANY),
+        call([message3], session, mock.ANY, mock.ANY),
+    ]
+    websocket.handle_message.assert_called_once_with(message2, session)
 
 
 def test_process_work_queue_uses_appropriate_topic_handlers_for_realtime_messages(session):
     message = messages.Message(topic='user', payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
     streamer.process_work_queue({},
                                 queue,
                                 session_factory=lambda _: session)
 
     topic_handlers = {
-        'annotation': messages.handle_annotation_event,
-        'user': messages.handle_user_event,
+        'annotation': messages.handle_annotation_events,
+        'user': messages.handle_user_events,
     }
 
-    messages.handle_message.assert_called_once_with(mock.ANY,
-                                                    session,
-                                                    topic_handlers=topic_handlers)
+    messages.handle_messages.assert_called_once_with(mock.ANY,
+                                                     session,
+                                                     topic_handlers=topic_handlers,
+                                                     stats=mock.ANY)
 
 
 def test_process_work_queue_sends_websocket_messages_to_websocket_handle_message(session):
     message = websocket.Message(socket=mock.sentinel.SOCKET, payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -50,7 +110,7 @@ def test_process_work_queue_sends_websocket_messages_to_websocket_handle_message
 def test_process_work_queue_commits_after_each_message(session):
     message1 = websocket.Message(socket=mock.sentinel.SOCKET, payload='bar')
     message2 = messages.Message(topic='user', payload='bar')
-    queue = [message1, message2]
+    queue = work_queue(message1, message2)
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -59,9 +119,9 @@ def test_process_work_queue_commits_after_each_message(session):
 
 def test_process_work_queue_rolls_back_on_handler_exception(session):
     message = messages.Message(topic='foo', payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
-    messages.handle_message.side_effect = RuntimeError('explosion')
+    messages.handle_messages.side_effect = RuntimeError('explosion')
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -71,7 +131,7 @@ def test_process_work_queue_rolls_back_on_handler_exception(session):
 
 def test_process_work_queue_rolls_back_on_unknown_message_type(session):
     message = 'something that is not a message'
-    queue = [message]
+    queue = work_queue(message)
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -81,7 +141,7 @@ def test_process_work_queue_rolls_back_on_unknown_message_type(session):
 
 def test_process_work_queue_calls_close_after_commit(session):
     message = messages.Message(topic='annotation', payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -93,9 +153,9 @@ def test_process_work_queue_calls_close_after_commit(session):
 
 def test_process_work_queue_calls_close_after_rollback(session):
     message = messages.Message(topic='foo', payload='bar')
-    queue = [message]
+    queue = work_queue(message)
 
-    messages.handle_message.side_effect = RuntimeError('explosion')
+    messages.handle_messages.side_effect = RuntimeError('explosion')
 
     streamer.process_work_queue({}, queue, session_factory=lambda _: session)
 
@@ -105,6 +165,56 @@ def test_process_work_queue_calls_close_after_rollback(session):
     ]
 
 
+class TestStart(object):
+    def test_it_uses_the_default_work_queue_size(self, event, work_queue):
+        streamer.start(event)
+
+        assert work_queue.maxsize == streamer.WORK_QUEUE_SIZE
+
+    def test_it_sets_the_work_queue_size_from_settings(self, event, work_queue):
+        event.app.registry.settings['h.streamer.work_queue_size'] = '128'
+
+        streamer.start(event)
+
+        assert work_queue.maxsize == 128
+
+    def test_it_processes_messages_from_each_topic(self, event, gevent, work_queue):
+        settings = event.app.registry.settings
+
+        streamer.start(event)
+
+        for topic in ('annotation', 'user'):
+            gevent.spawn.assert_any_call(messages.process_messages,
+                                         settings,
+                                         topic,
+                                         work_queue)
+
+    @pytest.fixture
+    def event(self):
+        event = mock.Mock()
+        event.app.registry.settings = {}
+        return event
+
+    @pytest.fixture
+    def work_queue(self, monkeypatch):
+        queue = Queue(maxsize=streamer.WORK_QUEUE_SIZE)
+        monkeypatch.setattr(streamer, 'WORK_QUEUE', queue)
+        return queue
+
+    @pytest.fixture(autouse=True)
+    def gevent(self, patch):
+        return patch('h.streamer.streamer.gevent')
+
+
+def work_queue(*items):
+    """Return a work queue which finishes iterating after the given items."""
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    queue.put(StopIteration)
+    return queue
+
+
 @pytest.fixture
 def session():
     return mock.Mock(spec_set=['close', 'commit', 'execute', 'rollback'])
@@ -116,5 +226,5 @@ def websocket_handle_message(patch):
 
 
 @pytest.fixture(autouse=True)
-def messages_handle_message(patch):
-    return patch('h.streamer.messages.handle_message')
+def messages_handle_messages(patch):
+    return patch('h.streamer.messages.handle_messages')
@@ -2,6 +2,7 @@
 
 from collections import namedtuple
 import json
+import weakref
 
 import mock
 import pytest
@@ -40,6 +41,78 @@ def test_websocket_removes_self_from_instance_list_when_closed(fake_environ):
     client1.closed(1000)
 
 
+def test_websocket_indexes_self_by_userid(fake_environ, instances_by_userid):
+    socket = mock.Mock()
+    client = websocket.WebSocket(socket, environ=fake_environ)
+
+    assert set(instances_by_userid['janet']) == set([client])
+
+
+def test_websocket_does_not_index_anonymous_websockets(fake_environ, instances_by_userid):
+    socket = mock.Mock()
+    fake_environ['h.ws.authenticated_userid'] = None
+
+    websocket.WebSocket(socket, environ=fake_environ)
+
+    assert instances_by_userid == {}
+
+
+def test_websocket_removes_self_from_userid_index_when_closed(fake_environ, instances_by_userid):
+    socket = mock.Mock()
+    client1 = websocket.WebSocket(socket, environ=fake_environ)
+    client2 = websocket.WebSocket(socket, environ=fake_environ)
+
+    client1.closed(1000)
+    assert set(instances_by_userid['janet']) == set([client2])
+    client2.closed(1000)
+    assert 'janet' not in instances_by_userid
+
+    # A second closure (however unusual) should not raise
+    client1.closed(1000)
+
+
+def test_websocket_user_instances_returns_users_websockets(fake_environ, instances_by_userid):
+    socket = mock.Mock()
+    client = websocket.WebSocket(socket, environ=fake_environ)
+
+    assert websocket.WebSocket.user_instances('janet') == (client,)
+    assert websocket.WebSocket.user_instances('bob') == ()
+
+
+def test_websocket_user_instances_removes_empty_entries(fake_environ, instances_by_userid):
+    # As left behind by websockets garbage collected without being closed.
+    instances_by_userid['janet'] = weakref.WeakSet()
+
+    assert websocket.WebSocket.user_instances('janet') == ()
+    assert 'janet' not in instances_by_userid
+
+
+def test_websocket_snapshot_returns_open_websockets(fake_environ):
+    socket = mock.Mock()
+    client1 = websocket.WebSocket(socket, environ=fake_environ)
+    client2 = websocket.WebSocket(socket, environ=fake_environ)
+
+    assert set(websocket.WebSocket.snapshot()) == set([client1, client2])
+
+
+def test_websocket_snapshot_is_reused_until_websockets_change(fake_environ):
+    socket = mock.Mock()
+    websocket.WebSocket(socket, environ=fake_environ)
+
+    assert websocket.WebSocket.snapshot() is websocket.WebSocket.snapshot()
+
+
+def test_websocket_snapshot_updated_when_websocket_closed(fake_environ):
+    socket = mock.Mock()
+    client1 = websocket.WebSocket(socket, environ=fake_environ)
+    client2 = websocket.WebSocket(socket, environ=fake_environ)
+    websocket.WebSocket.snapshot()
+
+    client1.closed(1000)
+
+    assert websocket.WebSocket.snapshot() == (client2,)
+
+
 def test_socket_enqueues_incoming_messages(fake_environ):
     socket = mock.Mock()
     client = websocket.WebSocket(socket, environ=fake_environ)
@@ -65,6 +138,17 @@ def test_socket_sets_auth_data_from_environ(fake_environ):
     ]
 
 
+def test_socket_sets_effective_principals_set_from_environ(fake_environ):
+    socket = mock.Mock()
+    client = websocket.WebSocket(socket, environ=fake_environ)
+
+    assert client.effective_principals_set == frozenset([
+        security.Everyone,
+        security.Authenticated,
+        'group:__world__',
+    ])
+
+
 def test_socket_sets_registry_from_environ(fake_environ):
     socket = mock.Mock()
     client = websocket.WebSocket(socket, environ=fake_environ)
@@ -72,25 +156,22 @@ def test_socket_sets_registry_from_environ(fake_environ):
     assert client.registry == mock.sentinel.registry
 
 
-def test_socket_send_json(fake_environ, fake_json, fake_socket_send):
+def test_socket_send_raw(fake_environ, fake_socket_send):
     socket = mock.Mock()
     client = websocket.WebSocket(socket, environ=fake_environ)
 
-    payload = {'foo': 'bar'}
-    client.send_json(payload)
+    client.send_raw('{"foo": "bar"}')
 
-    fake_json.dumps.assert_called_once_with(payload)
-    fake_socket_send.assert_called_once_with(client, fake_json.dumps.return_value)
+    fake_socket_send.assert_called_once_with(client, '{"foo": "bar"}')
 
 
-def test_socket_send_json_skips_when_terminated(fake_environ, fake_json, fake_socket_send, fake_socket_terminated):
+def test_socket_send_raw_skips_when_terminated(fake_environ, fake_socket_send, fake_socket_terminated):
     socket = mock.Mock()
     client = websocket.WebSocket(socket, environ=fake_environ)
 
     fake_socket_terminated.return_value = True
-    client.send_json({'foo': 'bar'})
+    client.send_raw('{"foo": "bar"}')
 
-    assert not fake_json.dumps.called
     assert not fake_socket_send.called
 
 
@@ -192,9 +273,11 @@ def fake_environ():
     }
 
 
-@pytest.fixture
-def fake_json(patch):
-    return patch('h.streamer.websocket.json')
+@pytest.fixture(autouse=True)
+def instances_by_userid(instances_by_userid):
+    # Every websocket made in these tests adds itself to the index, so don't
+    # let them leak into the real one.
+    return instances_by_userid
 
 
 @pytest.fixture
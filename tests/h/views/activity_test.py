@@ -1,16 +1,31 @@
 # -*- coding: utf-8 -*-
 
+import copy
 import datetime
 
 import pytest
 import mock
 from pyramid import httpexceptions
+from pyramid.config import Configurator
+from pyramid.interfaces import IRoutesMapper
 from webob.multidict import NestedMultiDict
 
+from h._compat import urlparse
 from h.views import activity
+from tests.common.factories import User as UserFactory
 
+# The routes that the activity views generate URLs for.
+ROUTES = (
+    ('activity.search', '/search'),
+    ('activity.group_search', '/groups/{pubid}/search'),
+    ('activity.user_search', '/users/{username}/search'),
+    ('group_read', '/groups/{pubid}/{slug}'),
+    ('group_edit', '/groups/{pubid}/edit'),
+    ('account_profile', '/account/profile'),
+)
 
-@pytest.mark.usefixtures('paginate', 'query', 'routes')
+
+@pytest.mark.usefixtures('paginate', 'query')
 class TestSearch(object):
     def test_it_returns_404_when_feature_turned_off(self, pyramid_request):
         pyramid_request.feature.flags['search_page'] = False
@@ -55,16 +70,14 @@ class TestSearch(object):
                                          mock.ANY,
                                          page_size=100)
 
-    def test_it_returns_group_suggestions(self,
-                                          factories,
-                                          pyramid_request,
-                                          query):
+    def test_it_returns_group_suggestions(self, pyramid_request, query):
         """It should return a list of group_suggestsions to the template."""
-        fake_group_1 = factories.Group()
-        fake_group_2 = factories.Group()
-        fake_group_3 = factories.Group()
-        pyramid_request.authenticated_user.groups = [
-            fake_group_1, fake_group_2, fake_group_3]
+        fake_group_1 = _fake_group(name='Group 1', pubid='pubid1')
+        fake_group_2 = _fake_group(name='Group 2', pubid='pubid2')
+        fake_group_3 = _fake_group(name='Group 3', pubid='pubid3')
+        pyramid_request.authenticated_user = mock.Mock(
+            spec_set=['groups'],
+            groups=[fake_group_1, fake_group_2, fake_group_3])
 
         result = activity.search(pyramid_request)
 
@@ -90,12 +103,26 @@ class TestSearch(object):
         assert user_link == 'http://example.com/users/jim.smith/search'
 
     @pytest.fixture
-    def query(self, patch):
-        return patch('h.views.activity.query')
+    def query(self, query_patcher):
+        query_patcher.reset_mock()
+        return query_patcher
+
+    @pytest.yield_fixture(scope='class')
+    def query_patcher(self):
+        patcher = mock.patch('h.views.activity.query', autospec=True)
+        yield patcher.start()
+        patcher.stop()
 
     @pytest.fixture
-    def paginate(self, patch):
-        return patch('h.views.activity.paginate')
+    def paginate(self, paginate_patcher):
+        paginate_patcher.reset_mock()
+        return paginate_patcher
+
+    @pytest.yield_fixture(scope='class')
+    def paginate_patcher(self):
+        patcher = mock.patch('h.views.activity.paginate', autospec=True)
+        yield patcher.start()
+        patcher.stop()
 
     @pytest.fixture
     def pyramid_request(self, factories, pyramid_request):
@@ -103,39 +130,39 @@ class TestSearch(object):
         return pyramid_request
 
 
-@pytest.mark.usefixtures('routes', 'search')
+@pytest.mark.usefixtures('search')
 class TestGroupSearch(object):
 
+    @pytest.mark.parametrize('which', ['none', 'creator', 'member'])
     def test_it_returns_404_when_feature_turned_off(self,
                                                     group,
-                                                    pyramid_request):
+                                                    pyramid_request,
+                                                    which):
         pyramid_request.feature.flags['search_page'] = False
+        pyramid_request.authenticated_user = _user(group, which)
 
-        for user in (None, group.creator, group.members[-1]):
-            pyramid_request.authenticated_user = user
-            with pytest.raises(httpexceptions.HTTPNotFound):
-                activity.group_search(pyramid_request)
+        with pytest.raises(httpexceptions.HTTPNotFound):
+            activity.group_search(pyramid_request)
 
+    @pytest.mark.parametrize('which', ['none', 'creator', 'member'])
     def test_it_calls_search_with_the_request(self,
                                               group,
                                               pyramid_request,
-                                              search):
-        for user in (None, group.creator, group.members[-1]):
-            pyramid_request.authenticated_user = user
-
-            activity.group_search(pyramid_request)
+                                              search,
+                                              which):
+        pyramid_request.authenticated_user = _user(group, which)
 
-            search.assert_called_once_with(pyramid_request)
+        activity.group_search(pyramid_request)
 
-            search.reset_mock()
+        search.assert_called_once_with(pyramid_request)
 
+    @pytest.mark.parametrize('which', ['none', 'creator', 'member'])
     def test_it_just_returns_search_result_if_group_does_not_exist(
-            self, group, pyramid_request, search):
-        for user in (None, group.creator, group.members[-1]):
-            pyramid_request.authenticated_user = user
-            pyramid_request.matchdict['pubid'] = 'does_not_exist'
+            self, group, pyramid_request, search, which):
+        pyramid_request.authenticated_user = _user(group, which)
+        pyramid_request.matchdict['pubid'] = 'does_not_exist'
 
-            assert activity.group_search(pyramid_request) == search.return_value
+        assert activity.group_search(pyramid_request) == search.return_value
 
     def test_it_just_returns_search_result_if_user_not_logged_in(
             self, pyramid_request, search):
@@ -150,8 +177,13 @@ class TestGroupSearch(object):
         assert activity.group_search(pyramid_request) == search.return_value
 
     def test_it_returns_group_info_if_user_a_member_of_group(self,
+                                                             factories,
                                                              group,
                                                              pyramid_request):
+        # Create some other groups as well, just to make sure it gets the
+        # right one from the db.
+        factories.Group()
+        factories.Group()
         pyramid_request.authenticated_user = group.members[-1]
 
         group_info = activity.group_search(pyramid_request)['group']
@@ -173,7 +205,6 @@ class TestGroupSearch(object):
     def test_it_does_not_show_the_edit_link_to_group_members(self,
                                                              group,
                                                              pyramid_request):
-        pyramid_request.has_permission = mock.Mock(return_value=False)
         pyramid_request.authenticated_user = group.members[-1]
 
         result = activity.group_search(pyramid_request)
@@ -182,7 +213,7 @@ class TestGroupSearch(object):
 
     def test_it_does_show_the_group_edit_link_to_group_creators(
             self, group, pyramid_request):
-        pyramid_request.has_permission = mock.Mock(return_value=True)
+        pyramid_request.has_permission.return_value = True
         pyramid_request.authenticated_user = group.creator
 
         result = activity.group_search(pyramid_request)
@@ -219,52 +250,40 @@ class TestGroupSearch(object):
         assert result['opts']['search_groupname'] == 'does_not_exist'
 
     def test_it_returns_group_members_usernames(self, pyramid_request, group):
-        pyramid_request.has_permission = mock.Mock(return_value=False)
         pyramid_request.authenticated_user = group.members[-1]
 
         result = activity.group_search(pyramid_request)
 
-        actual = set([m['username'] for m in result['group']['members']])
-        expected = set([m.username for m in group.members])
+        actual = {m['username'] for m in result['group']['members']}
+        expected = {m.username for m in group.members}
         assert actual == expected
 
     def test_it_returns_group_members_userid(self, pyramid_request, group):
-        pyramid_request.has_permission = mock.Mock(return_value=False)
         pyramid_request.authenticated_user = group.members[-1]
 
         result = activity.group_search(pyramid_request)
 
-        actual = set([m['userid'] for m in result['group']['members']])
-        expected = set([m.userid for m in group.members])
+        actual = {m['userid'] for m in result['group']['members']}
+        expected = {m.userid for m in group.members}
         assert actual == expected
 
     def test_it_returns_group_members_faceted_by(self, pyramid_request, group):
-        pyramid_request.has_permission = mock.Mock(return_value=False)
         pyramid_request.authenticated_user = group.members[-1]
 
         faceted_user = group.members[0]
-        pyramid_request.POST = {'q': 'user:%s' % group.members[0].username}
+        pyramid_request.POST = _post(q='user:%s' % group.members[0].username)
 
         result = activity.group_search(pyramid_request)
 
         for member in result['group']['members']:
             assert member['faceted_by'] is (member['userid'] == faceted_user.userid)
 
-    def test_it_returns_annotation_count_for_group_members(self, pyramid_request, group, search, factories):
-        user_1 = factories.User()
-        user_2 = factories.User()
-        group.members = [user_1, user_2]
-
-        pyramid_request.has_permission = mock.Mock(return_value=False)
+    def test_it_returns_annotation_count_for_group_members(self, pyramid_request, group, search):
         pyramid_request.authenticated_user = group.members[-1]
 
-        counts = {user_1.userid: 24, user_2.userid: 6}
-        search.return_value = {
-            'aggregations': {
-                'users': [{'user': user_1.userid, 'count': counts[user_1.userid]},
-                          {'user': user_2.userid, 'count': counts[user_2.userid]}]
-            },
-        }
+        counts = {member.userid: 6 * (i + 1)
+                  for i, member in enumerate(group.members)}
+        search.return_value = _aggregations(counts)
 
         result = activity.group_search(pyramid_request)
 
@@ -280,7 +299,6 @@ class TestGroupSearch(object):
 
 
 
-@pytest.mark.usefixtures('routes')
 class TestSearchMoreInfo(object):
 
     def test_it_redirects_to_group_search(self, pyramid_request):
@@ -288,37 +306,30 @@ class TestSearchMoreInfo(object):
         pyramid_request.matchdict['pubid'] = 'test_pubid'
         pyramid_request.matched_route = mock.Mock()
         pyramid_request.matched_route.name = 'activity.group_search'
-        pyramid_request.POST = {'q': 'foo bar', 'more_info': ''}
+        pyramid_request.POST = _post(q='foo bar', more_info='')
 
         result = activity.search_more_info(pyramid_request)
 
         assert isinstance(result, httpexceptions.HTTPSeeOther)
-        assert result.location.startswith(
-            'http://example.com/groups/test_pubid/search?')
-        # The order of the params vary (because they're in an unordered dict)
-        # but they should both be there.
-        assert 'more_info=' in result.location
-        assert 'q=foo+bar' in result.location
+        assert _split(result.location) == (
+            'http://example.com/groups/test_pubid/search',
+            {'q': ['foo bar'], 'more_info': ['']})
 
     def test_it_redirects_to_user_search(self, pyramid_request):
         """It should redirect and preserve the search query param."""
         pyramid_request.matchdict['username'] = 'test_username'
         pyramid_request.matched_route = mock.Mock()
         pyramid_request.matched_route.name = 'activity.user_search'
-        pyramid_request.POST = {'q': 'foo bar', 'more_info': ''}
+        pyramid_request.POST = _post(q='foo bar', more_info='')
 
         result = activity.search_more_info(pyramid_request)
 
         assert isinstance(result, httpexceptions.HTTPSeeOther)
-        assert result.location.startswith(
-            'http://example.com/users/test_username/search?')
-        # The order of the params vary (because they're in an unordered dict)
-        # but they should both be there.
-        assert 'more_info=' in result.location
-        assert 'q=foo+bar' in result.location
+        assert _split(result.location) == (
+            'http://example.com/users/test_username/search',
+            {'q': ['foo bar'], 'more_info': ['']})
 
 
-@pytest.mark.usefixtures('routes')
 class TestSearchBack(object):
 
     def test_it_redirects_to_group_search(self, pyramid_request):
@@ -326,7 +337,7 @@ class TestSearchBack(object):
         pyramid_request.matchdict['pubid'] = 'test_pubid'
         pyramid_request.matched_route = mock.Mock()
         pyramid_request.matched_route.name = 'activity.group_search'
-        pyramid_request.POST = {'q': 'foo bar', 'back': ''}
+        pyramid_request.POST = _post(q='foo bar', back='')
 
         result = activity.search_back(pyramid_request)
 
@@ -339,7 +350,7 @@ class TestSearchBack(object):
         pyramid_request.matchdict['username'] = 'test_username'
         pyramid_request.matched_route = mock.Mock()
         pyramid_request.matched_route.name = 'activity.user_search'
-        pyramid_request.POST = {'q': 'foo bar', 'back': ''}
+        pyramid_request.POST = _post(q='foo bar', back='')
 
         result = activity.search_back(pyramid_request)
 
@@ -349,23 +360,23 @@ class TestSearchBack(object):
 
 
 
-@pytest.mark.usefixtures('groups_service', 'routes')
+@pytest.mark.usefixtures('groups_service')
 class TestGroupLeave(object):
 
+    @pytest.mark.parametrize('which', ['none', 'creator', 'member'])
     def test_it_returns_404_when_feature_turned_off(self,
                                                     group,
-                                                    pyramid_request):
+                                                    pyramid_request,
+                                                    which):
         pyramid_request.feature.flags['search_page'] = False
+        pyramid_request.authenticated_user = _user(group, which)
 
-        for user in (None, group.creator, group.members[-1]):
-            pyramid_request.authenticated_user = user
-            with pytest.raises(httpexceptions.HTTPNotFound):
-                activity.group_leave(pyramid_request)
+        with pytest.raises(httpexceptions.HTTPNotFound):
+            activity.group_leave(pyramid_request)
 
     def test_it_returns_404_when_the_group_does_not_exist(self,
                                                           pyramid_request):
-        pyramid_request.POST = NestedMultiDict({
-            'group_leave': 'does_not_exist'})
+        pyramid_request.POST = _post(group_leave='does_not_exist')
 
         with pytest.raises(httpexceptions.HTTPNotFound):
             activity.group_leave(pyramid_request)
@@ -383,29 +394,31 @@ class TestGroupLeave(object):
             group, group.members[-1].userid)
 
     def test_it_redirects_to_the_search_page(self, group, pyramid_request):
-        # This should be in the redirect URL.
-        pyramid_request.POST['q'] = 'foo bar gar'
-        # This should *not* be in the redirect URL.
-        pyramid_request.POST['group_leave'] = group.pubid
+        pyramid_request.POST = _post(
+            # This should be in the redirect URL.
+            q='foo bar gar',
+            # This should *not* be in the redirect URL.
+            group_leave=group.pubid,
+        )
         result = activity.group_leave(pyramid_request)
 
         assert isinstance(result, httpexceptions.HTTPSeeOther)
         assert result.location == 'http://example.com/search?q=foo+bar+gar'
 
     @pytest.fixture
-    def groups_service(self, patch, pyramid_config):
-        groups_service = patch('h.groups.services.GroupsService')
+    def groups_service(self, pyramid_config):
+        groups_service = mock.Mock(spec_set=['member_leave'])
         pyramid_config.register_service(groups_service, name='groups')
         return groups_service
 
     @pytest.fixture
     def pyramid_request(self, group, pyramid_request):
-        pyramid_request.POST = {'group_leave': group.pubid}
+        pyramid_request.POST = _post(group_leave=group.pubid)
         return pyramid_request
 
 
 
-@pytest.mark.usefixtures('routes', 'search', 'user_service')
+@pytest.mark.usefixtures('search', 'user_service')
 class TestUserSearch(object):
     def test_it_returns_404_when_feature_turned_off(self,
                                                     pyramid_request):
@@ -459,16 +472,18 @@ class TestUserSearch(object):
         assert 'user' not in activity.user_search(pyramid_request)
 
     def test_it_passes_the_username_to_the_template_if_the_user_has_no_display_name(
-            self, pyramid_request, user):
-        user.display_name = None
+            self, pyramid_request, user_service):
+        user = UserFactory.build(display_name=None)
+        user_service.fetch.return_value = user
 
         username = activity.user_search(pyramid_request)['user']['name']
 
         assert username == user.username
 
     def test_it_passes_the_display_name_to_the_template_if_the_user_has_one(
-            self, pyramid_request, user):
-        user.display_name = "Display Name"
+            self, pyramid_request, user_service):
+        user = UserFactory.build(display_name="Display Name")
+        user_service.fetch.return_value = user
 
         username = activity.user_search(pyramid_request)['user']['name']
 
@@ -531,9 +546,11 @@ class TestUserSearch(object):
         pyramid_request.authenticated_user = user
         return pyramid_request
 
-    @pytest.fixture
-    def user(self, factories):
-        return factories.User()
+    @pytest.fixture(scope='class')
+    def user(self):
+        # UserFactory doesn't touch the database, so a single user can be
+        # shared by the whole class. Tests must not modify it.
+        return UserFactory.build()
 
     @pytest.fixture
     def user_service(self, pyramid_config, user):
@@ -543,7 +560,6 @@ class TestUserSearch(object):
         return user_service
 
 
-@pytest.mark.usefixtures('routes')
 class TestDeleteLozenge(object):
 
     def test_it_returns_a_redirect(self, pyramid_request):
@@ -557,11 +573,12 @@ class TestDeleteLozenge(object):
         assert result.location == 'http://example.com/search'
 
     def test_it_preserves_the_query_param(self, pyramid_request):
-        pyramid_request.POST['q'] = 'foo bar'
+        pyramid_request.params['q'] = 'foo bar'
 
         location = activity.delete_lozenge(pyramid_request).location
 
-        location == 'http://example.com/search?q=foo+bar'
+        assert _split(location) == ('http://example.com/search',
+                                    {'q': ['foo bar']})
 
     @pytest.fixture
     def pyramid_request(self, pyramid_request):
@@ -569,83 +586,56 @@ class TestDeleteLozenge(object):
         return pyramid_request
 
 
-@pytest.mark.usefixtures('routes', 'search')
+@pytest.mark.usefixtures('search')
 class TestToggleUserFacet(object):
 
+    @pytest.mark.parametrize('which', ['none', 'creator', 'member'])
     def test_it_returns_404_when_feature_turned_off(self,
                                                     group,
-                                                    pyramid_request):
+                                                    pyramid_request,
+                                                    which):
         pyramid_request.feature.flags['search_page'] = False
+        pyramid_request.authenticated_user = _user(group, which)
 
-        for user in (None, group.creator, group.members[-1]):
-            pyramid_request.authenticated_user = user
-            with pytest.raises(httpexceptions.HTTPNotFound):
-                activity.toggle_user_facet(pyramid_request)
+        with pytest.raises(httpexceptions.HTTPNotFound):
+            activity.toggle_user_facet(pyramid_request)
 
     def test_it_returns_a_redirect(self, pyramid_request):
         result = activity.toggle_user_facet(pyramid_request)
 
         assert isinstance(result, httpexceptions.HTTPSeeOther)
 
-    def test_it_adds_the_user_facet_into_the_url(self, group, pyramid_request):
-        result = activity.toggle_user_facet(pyramid_request)
-
-        assert result.location == (
-            'http://example.com/groups/{pubid}/search'
-            '?q=user%3Afred'.format(pubid=group.pubid))
-
-    def test_it_removes_the_user_facet_from_the_url(self,
-                                                    group,
-                                                    pyramid_request):
-        pyramid_request.POST['q'] = 'user:"fred"'
+    @pytest.mark.parametrize('q,expected_q', [
+        (None, 'user:fred'),                        # Adds the user facet.
+        ('user:"fred"', ''),                        # Removes the user facet.
+        ('foo bar', 'foo bar user:fred'),           # Preserves the query.
+        ('user:"fred" foo bar', 'foo bar'),
+        ('user:"foo" user:"fred" user:"bar"', 'user:foo user:bar'),
+    ])
+    def test_it_toggles_the_user_facet(self,
+                                       group,
+                                       pyramid_request,
+                                       q,
+                                       expected_q):
+        if q is not None:
+            pyramid_request.POST = _post(
+                q=q, toggle_user_facet='acct:fred@hypothes.is')
 
         result = activity.toggle_user_facet(pyramid_request)
 
-        assert result.location == (
-            'http://example.com/groups/{pubid}/search?q='.format(
-                pubid=group.pubid))
-
-    def test_it_preserves_query_when_adding_user_facet(self,
-                                                       group,
-                                                       pyramid_request):
-        pyramid_request.POST['q'] = 'foo bar'
-
-        result = activity.toggle_user_facet(pyramid_request)
-
-        assert result.location == (
-            'http://example.com/groups/{pubid}/search'
-            '?q=foo+bar+user%3Afred'.format(pubid=group.pubid))
-
-    def test_it_preserves_query_when_removing_user_facet(self,
-                                                         group,
-                                                         pyramid_request):
-        pyramid_request.POST['q'] = 'user:"fred" foo bar'
-
-        result = activity.toggle_user_facet(pyramid_request)
-
-        assert result.location == (
-            'http://example.com/groups/{pubid}/search'
-            '?q=foo+bar'.format(pubid=group.pubid))
-
-    def test_it_preserves_query_when_removing_one_of_multiple_username_facets(
-            self, group, pyramid_request):
-        pyramid_request.POST['q'] = 'user:"foo" user:"fred" user:"bar"'
-
-        result = activity.toggle_user_facet(pyramid_request)
-
-        assert result.location == (
-            'http://example.com/groups/{pubid}/search'
-            '?q=user%3Afoo+user%3Abar'.format(pubid=group.pubid))
+        assert _split(result.location) == (
+            'http://example.com/groups/{pubid}/search'.format(
+                pubid=group.pubid),
+            {'q': [expected_q]})
 
     @pytest.fixture
     def pyramid_request(self, group, pyramid_request):
-        pyramid_request.feature.flags['search_page'] = True
-        pyramid_request.POST['toggle_user_facet'] = 'acct:fred@hypothes.is'
+        pyramid_request.POST = _post(toggle_user_facet='acct:fred@hypothes.is')
         pyramid_request.matchdict['pubid'] = group.pubid
         return pyramid_request
 
 
-@pytest.mark.usefixtures('routes', 'search')
+@pytest.mark.usefixtures('search')
 class TestToggleTagFacet(object):
 
     def test_it_returns_404_when_feature_turned_off(self,
@@ -660,106 +650,125 @@ class TestToggleTagFacet(object):
 
         assert isinstance(result, httpexceptions.HTTPSeeOther)
 
-    def test_it_adds_the_tag_facet_into_the_url(self, pyramid_request):
-        result = activity.toggle_tag_facet(pyramid_request)
+    @pytest.mark.parametrize('q,expected_q', [
+        (None, 'tag:gar'),                          # Adds the tag facet.
+        ('tag:"gar"', ''),                          # Removes the tag facet.
+        ('foo bar', 'foo bar tag:gar'),             # Preserves the query.
+        ('tag:"gar" foo bar', 'foo bar'),
+        ('tag:"foo" tag:"gar" tag:"bar"', 'tag:foo tag:bar'),
+    ])
+    def test_it_toggles_the_tag_facet(self, pyramid_request, q, expected_q):
+        if q is not None:
+            pyramid_request.POST = _post(q=q, toggle_tag_facet='gar')
 
-        assert result.location == (
-            'http://example.com/users/foo/search'
-            '?q=tag%3Agar')
+        result = activity.toggle_tag_facet(pyramid_request)
 
-    def test_it_removes_the_tag_facet_from_the_url(self,
-                                                   pyramid_request):
-        pyramid_request.POST['q'] = 'tag:"gar"'
+        assert _split(result.location) == (
+            'http://example.com/users/foo/search',
+            {'q': [expected_q]})
 
-        result = activity.toggle_tag_facet(pyramid_request)
+    @pytest.fixture
+    def pyramid_request(self, pyramid_request):
+        pyramid_request.matched_route = mock.Mock()
+        pyramid_request.matched_route.name='activity.user_search'
+        pyramid_request.POST = _post(toggle_tag_facet='gar')
+        pyramid_request.matchdict['username'] = 'foo'
+        return pyramid_request
 
-        assert result.location == (
-            'http://example.com/users/foo/search?q=')
 
-    def test_it_preserves_query_when_adding_tag_facet(self,
-                                                      pyramid_request):
-        pyramid_request.POST['q'] = 'foo bar'
+def _post(**kwargs):
+    """
+    Return a read-only MultiDict to use as a request's POST params.
 
-        result = activity.toggle_tag_facet(pyramid_request)
+    pyramid_request.POST and pyramid_request.params are the same object so
+    tests mustn't modify POST in place. Tests that need POST to differ from
+    params assign a new one made by this function instead.
 
-        assert result.location == (
-            'http://example.com/users/foo/search'
-            '?q=foo+bar+tag%3Agar')
+    """
+    return NestedMultiDict(kwargs)
 
-    def test_it_preserves_query_when_removing_tag_facet(self,
-                                                         pyramid_request):
-        pyramid_request.POST['q'] = 'tag:"gar" foo bar'
 
-        result = activity.toggle_tag_facet(pyramid_request)
+def _split(location):
+    """Split a redirect location into its base URL and parsed query."""
+    parts = urlparse.urlsplit(location)
+    base = urlparse.urlunsplit(parts[:3] + ('', ''))
+    return base, urlparse.parse_qs(parts.query, keep_blank_values=True)
 
-        assert result.location == (
-            'http://example.com/users/foo/search'
-            '?q=foo+bar')
 
-    def test_it_preserves_query_when_removing_one_of_multiple_tag_facets(self,
-                                                                         pyramid_request):
-        pyramid_request.POST['q'] = 'tag:"foo" tag:"gar" tag:"bar"'
+def _aggregations(counts):
+    """Return a search result with the given annotation counts by userid."""
+    return {
+        'aggregations': {
+            'users': [{'user': userid, 'count': count}
+                      for userid, count in counts.items()],
+        },
+    }
 
-        result = activity.toggle_tag_facet(pyramid_request)
 
-        assert result.location == (
-            'http://example.com/users/foo/search'
-            '?q=tag%3Afoo+tag%3Abar')
+def _fake_group(name, pubid):
+    group = mock.Mock(spec_set=['name', 'pubid'], pubid=pubid)
+    # ``name`` is a Mock constructor argument, so it has to be set afterwards.
+    group.name = name
+    return group
 
-    @pytest.fixture
-    def pyramid_request(self, pyramid_request):
-        pyramid_request.matched_route = mock.Mock()
-        pyramid_request.matched_route.name='activity.user_search'
-        pyramid_request.feature.flags['search_page'] = True
-        pyramid_request.POST['toggle_tag_facet'] = 'gar'
-        pyramid_request.matchdict['username'] = 'foo'
-        return pyramid_request
 
-    @pytest.fixture
-    def routes(self, pyramid_config):
-        pyramid_config.add_route('activity.user_search',
-                                 '/users/{username}/search')
+def _user(group, which):
+    """Return the ``which`` ('none', 'creator' or 'member') user of group."""
+    return {
+        'none': None,
+        'creator': group.creator,
+        'member': group.members[-1],
+    }[which]
 
 
 @pytest.fixture
 def group(factories):
-    # Create some other groups as well, just to make sure it gets the right
-    # one from the db.
-    factories.Group()
-    factories.Group()
-
     group = factories.Group()
     group.members.extend([factories.User(), factories.User()])
     return group
 
 
-@pytest.fixture
-def pyramid_request(pyramid_request):
-    # Disconnect pyramid_request.POST from pyramid_request.params.
-    # By default pyramid_request.POST and pyramid_request.params are the
-    # same object so modifying one modifies the other. We actually want to
-    # modify POST without modifying params in some of these tests so set them
-    # to different objects.
-    pyramid_request.POST = pyramid_request.params.copy()
+@pytest.fixture(autouse=True)
+def routes(pyramid_config, routes_mapper):
+    # Give each test its own copy of the mapper so that any routes a test adds
+    # don't leak into other tests. Copying it is much cheaper than adding the
+    # routes again.
+    pyramid_config.registry.registerUtility(copy.deepcopy(routes_mapper),
+                                            IRoutesMapper)
 
-    pyramid_request.feature.flags['search_page'] = True
-    return pyramid_request
 
+@pytest.fixture(scope='session')
+def routes_mapper():
+    config = Configurator()
+    config.include(_add_routes)
+    config.commit()
+    return config.get_routes_mapper()
 
-@pytest.fixture
-def routes(pyramid_config):
-    pyramid_config.add_route('activity.search', '/search')
-    pyramid_config.add_route('activity.group_search', '/groups/{pubid}/search')
-    pyramid_config.add_route('activity.user_search', '/users/{username}/search')
-    pyramid_config.add_route('group_read', '/groups/{pubid}/{slug}')
-    pyramid_config.add_route('group_edit', '/groups/{pubid}/edit')
-    pyramid_config.add_route('account_profile', '/account/profile')
+
+def _add_routes(config):
+    for name, pattern in ROUTES:
+        config.add_route(name, pattern)
 
 
 @pytest.fixture
-def search(patch):
-    search = patch('h.views.activity.search')
-    search.return_value = {
+def search(search_patcher):
+    search_patcher.reset_mock()
+    # This has to be a new dict for each test: group_search() and
+    # user_search() add their own keys to the search result they're given.
+    search_patcher.return_value = {
         'total': 200,
     }
-    return search
+    return search_patcher
+
+
+@pytest.yield_fixture(scope='class')
+def search_patcher():
+    # Patch h.views.activity.search once per test class rather than once per
+    # test. The search fixture resets it between tests.
+    #
+    # Don't widen this to module scope: the patch would then stay in place
+    # after the first class that uses it, and TestSearch (which tests the
+    # real activity.search view) would only pass if it happened to run first.
+    patcher = mock.patch('h.views.activity.search', autospec=True)
+    yield patcher.start()
+    patcher.stop()